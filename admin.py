@@ -1,12 +1,16 @@
+import html
 import logging
-import asyncio
+import os
 import time
 from functools import wraps
 from telegram import Update
 from telegram.ext import ContextTypes
-from telegram.error import TelegramError
-from config import ADMIN_ID
+from config import ADMIN_ID, PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS
 import database
+import broadcast
+import metrics
+import profiler
+from games import GAMES
 
 logger = logging.getLogger(__name__)
 
@@ -28,7 +32,9 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/add_balance <code>[user_id] [amount]</code> - Начислить баланс\n"
         "/sub_balance <code>[user_id] [amount]</code> - Списать баланс\n"
         "/broadcast <code>[message]</code> - Сделать рассылку\n"
-        "/server_stats - Показать статистику сервера"
+        "/server_stats - Показать статистику сервера\n"
+        "/profile <code>[секунд]</code> - Профилировать бота под текущей нагрузкой\n"
+        "/reconcile_stats - Пересчитать статистику сервера с нуля"
     )
     await update.message.reply_html(text)
 
@@ -37,7 +43,13 @@ async def check_user_balance(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try:
         target_id = int(context.args[0])
         balance = await database.get_user_balance(target_id)
-        await update.message.reply_text(f"Баланс пользователя {target_id}: {balance} ⭐")
+        text = f"Баланс пользователя {target_id}: {balance} ⭐"
+        recent_bets = await database.get_user_bets(target_id)
+        if recent_bets:
+            text += "\n\nПоследние ставки:"
+            for bet in recent_bets:
+                text += f"\n{bet['created_at']} {GAMES[bet['game']].emoji} ставка {bet['bet']}, выпало {bet['dice_value']}, выигрыш {bet['payout']}"
+        await update.message.reply_text(text)
     except (IndexError, ValueError):
         await update.message.reply_text("Использование: /check_balance [user_id]")
 
@@ -46,8 +58,7 @@ async def add_to_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         target_id = int(context.args[0])
         amount = int(context.args[1])
-        await database.update_user_balance(target_id, amount, relative=True)
-        new_balance = await database.get_user_balance(target_id)
+        new_balance = await database.update_user_balance(target_id, amount, relative=True)
         await update.message.reply_text(f"Баланс пользователя {target_id} пополнен на {amount}. Новый баланс: {new_balance} ⭐")
     except (IndexError, ValueError):
         await update.message.reply_text("Использование: /add_balance [user_id] [amount]")
@@ -57,20 +68,11 @@ async def subtract_from_balance(update: Update, context: ContextTypes.DEFAULT_TY
     try:
         target_id = int(context.args[0])
         amount = int(context.args[1])
-        await database.update_user_balance(target_id, -amount, relative=True)
-        new_balance = await database.get_user_balance(target_id)
+        new_balance = await database.update_user_balance(target_id, -amount, relative=True)
         await update.message.reply_text(f"С баланса пользователя {target_id} списано {amount}. Новый баланс: {new_balance} ⭐")
     except (IndexError, ValueError):
         await update.message.reply_text("Использование: /sub_balance [user_id] [amount]")
 
-async def send_message_to_user(bot, user_id: int, message: str) -> bool:
-    try:
-        await bot.send_message(chat_id=user_id, text=message, parse_mode='HTML')
-        return True
-    except TelegramError as e:
-        logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-        return False
-
 @admin_only
 async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_to_send = " ".join(context.args)
@@ -78,24 +80,10 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пожалуйста, укажите текст для рассылки. /broadcast [текст]")
         return
 
-    await update.message.reply_text("⏳ Начинаю рассылку...")
-    start_time = time.time()
-    
-    user_ids = await database.get_all_user_ids()
-    tasks = [send_message_to_user(context.bot, user_id, message_to_send) for user_id in user_ids]
-    results = await asyncio.gather(*tasks)
-    
-    end_time = time.time()
-    duration = end_time - start_time
-    
-    success_count = sum(results)
-    fail_count = len(user_ids) - success_count
-    
-    await update.message.reply_text(
-        f"✅ Рассылка завершена за {duration:.2f} сек.\n"
-        f"Успешно отправлено: {success_count}\n"
-        f"Не удалось отправить: {fail_count}"
-    )
+    # Рассылка идет в фоне с ограничением частоты; итог придет отдельным сообщением
+    new_broadcast = await database.create_broadcast(message_to_send, update.effective_chat.id)
+    broadcast.start_broadcast(context.bot, new_broadcast)
+    await update.message.reply_text(f"⏳ Рассылка #{new_broadcast['id']} запущена...")
 
 @admin_only
 async def show_server_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -109,6 +97,13 @@ async def show_server_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     avg_balance = (stats['total_balance'] / total_users) if total_users > 0 else 0
     avg_games = (stats['total_games'] / total_users) if total_users > 0 else 0
     
+    cache = database.get_cache_stats()
+    game_stats = await database.get_game_stats(list(GAMES))
+    games_text = "\n".join(
+        f"{GAMES[key].emoji} ставок: {row['bets']}, RTP: "
+        f"{(row['paid'] / row['wagered']) if row['wagered'] else 0:.1%} / {GAMES[key].rtp:.1%}"
+        for key, row in game_stats.items()
+    )
     casino_profit = -stats['casino_profit']
     profit_sign = "+" if casino_profit >= 0 else ""
     profit_emoji = "📈" if casino_profit >= 0 else "📉"
@@ -122,7 +117,59 @@ async def show_server_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"{profit_emoji} Прибыль казино: <b>{profit_sign}{casino_profit}</b> ⭐\n\n"
         f"<b>Аналитика:</b>\n"
         f"💰 Средний баланс на игрока: <b>{avg_balance:.2f}</b> ⭐\n"
-        f"🎮 Среднее кол-во игр на игрока: <b>{avg_games:.2f}</b>"
+        f"🎮 Среднее кол-во игр на игрока: <b>{avg_games:.2f}</b>\n\n"
+        f"<b>Игры за 24 часа</b> (фактический / теоретический RTP):\n"
+        f"{games_text}\n\n"
+        f"<b>Кэш балансов:</b> {cache['size']}/{cache['max_size']}, "
+        f"попаданий {cache['hits']}, промахов {cache['misses']} ({cache['hit_rate']:.1%})\n\n"
+        f"<b>⏱ Производительность</b> (с момента запуска процесса):\n"
+        f"{metrics.summary()}"
     )
     
-    await update.message.reply_html(text)
\ No newline at end of file
+    await update.message.reply_html(text)
+
+@admin_only
+async def reconcile_server_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    drift = await database.reconcile_totals()
+    if not drift:
+        await update.message.reply_text("✅ Статистика сервера сходится с данными пользователей.")
+        return
+
+    lines = [f"{key}: {stored} → {actual}" for key, (stored, actual) in drift.items()]
+    await update.message.reply_text("⚠️ Найдены и исправлены расхождения:\n" + "\n".join(lines))
+
+@admin_only
+async def profile_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        seconds = float(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text("Использование: /profile [секунд]")
+        return
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+    if profiler.is_running():
+        await update.message.reply_text("Профилирование уже идет, дождитесь результата.")
+        return
+
+    # Сессия идет в фоне: обработчик не держит очередь обновлений администратора
+    profiler.start_session(_send_profile(update, seconds))
+    await update.message.reply_text(f"⏱ Профилирование запущено на {seconds:g} сек.")
+
+async def _send_profile(update: Update, seconds: float):
+    start = time.monotonic()
+    try:
+        summary, path = await profiler.run_session(seconds)
+    except RuntimeError as e:
+        await update.message.reply_text(str(e))
+        return
+    elapsed = time.monotonic() - start
+    # Сессия короче заказанной — бот останавливается и завершил ее досрочно
+    title = f"Профиль за {seconds:g} сек." if elapsed >= seconds else f"Профиль за {elapsed:.0f} сек. (остановлен досрочно)"
+    try:
+        await update.message.reply_html(f"<b>{title}</b>\n<pre>{html.escape(summary)}</pre>")
+        with open(path, "rb") as f:
+            await update.message.reply_document(f, filename=os.path.basename(path),
+                                                caption="Открыть: python -m pstats <файл> или snakeviz")
+    except Exception as e:
+        logger.error(f"Не удалось отправить профиль: {e}")
+    finally:
+        os.remove(path)
@@ -0,0 +1,55 @@
+"""Общие функции бенчмарков: перцентили, сохранение результатов и эталонов"""
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+def use_repo_modules(**env: str):
+    """Делает модули бота импортируемыми; env выставляется до импорта config"""
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+    os.environ.setdefault("TELEGRAM_TOKEN", "123456:BENCHMARK")
+    os.environ.update(env)
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+    return {
+        "count": len(ordered),
+        "p50_ms": round(pick(50) * 1000, 3),
+        "p95_ms": round(pick(95) * 1000, 3),
+        "p99_ms": round(pick(99) * 1000, 3),
+    }
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def new_report(config: dict) -> dict:
+    return {"commit": git_commit(), "created_at": datetime.now().isoformat(timespec="seconds"), "config": config}
+
+def save_report(report: dict, name: str, output: str | None = None, baseline: str | None = None):
+    """Пишет отчет в benchmarks/results/ (или output) и, если задано, в benchmarks/baselines/<baseline>.json"""
+    paths = [output or os.path.join(BENCH_DIR, "results", f"{name}_{datetime.now():%Y%m%d_%H%M%S}.json")]
+    if baseline:
+        paths.append(os.path.join(BENCH_DIR, "baselines", f"{baseline}.json"))
+    for path in paths:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультат сохранен: {path}")
+
+def load_report(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def change(new: float, old: float) -> str:
+    return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
@@ -0,0 +1,329 @@
+"""Микробенчмарки функций database.py на таблицах реалистичного размера.
+
+Для каждого размера (по умолчанию 10k, 100k и 1M пользователей) создается
+отдельная БД со схемой init_db, пользователями и рефералами. Сгенерированные
+файлы кэшируются в benchmarks/.data/ и пересоздаются с --reseed; замеры идут
+на временной копии, чтобы записи не меняли закэшированные данные.
+
+Каждая операция замеряется последовательно (одна задача) и конкурентно
+(--concurrency задач через пул соединений): операций в секунду и p50/p95/p99.
+Кэши database сбрасываются перед каждым замером. С --compare результат
+сравнивается с эталоном, а при --threshold процент ухудшения p95 или
+пропускной способности выше порога считается регрессией (код выхода 1).
+
+С --check-plans вместо замеров каждая функция database вызывается по разу на
+копии самой большой БД в режиме DB_STRICT_PLANS: полный просмотр таблицы, не
+помеченный в database.py как намеренный, считается ошибкой (код выхода 1).
+
+Пример:
+    python benchmarks/db_bench.py --sizes 10000 100000
+    python benchmarks/db_bench.py --sizes 1000000 --check-plans
+    python benchmarks/db_bench.py --save-baseline main
+    python benchmarks/db_bench.py --compare benchmarks/baselines/db_main.json --threshold 20
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from common import BENCH_DIR, change, load_report, new_report, percentiles, save_report, use_repo_modules
+
+DATA_DIR = os.path.join(BENCH_DIR, ".data")
+SEED_BATCH = 50_000
+# Доля пользователей, пришедших по приглашению, и доля приглашающих среди всех
+REFERRED_SHARE = 0.3
+REFERRER_SHARE = 0.01
+# Доля пользователей без реферального кода (зарегистрированы до его появления)
+NO_CODE_SHARE = 0.1
+
+# ==================== ПОДГОТОВКА ДАННЫХ ====================
+
+def seed_path(size: int) -> str:
+    return os.path.join(DATA_DIR, f"users_{size}.db")
+
+def copy_seed(size: int, prefix: str) -> tuple[str, str]:
+    """Копирует БД во временный каталог, чтобы запись при замерах не меняла эталонные данные.
+
+    Возвращает (каталог, путь к копии); каталог удаляет вызывающий.
+    """
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    path = os.path.join(workdir, os.path.basename(seed_path(size)))
+    for suffix in ("", "-wal"):
+        if os.path.exists(seed_path(size) + suffix):
+            shutil.copy(seed_path(size) + suffix, path + suffix)
+    return workdir, path
+
+async def _create_schema(path: str):
+    import database
+    await database.init_pool(path, readers=1)
+    try:
+        await database.init_db()
+    finally:
+        await database.close_pool()
+
+def seed(size: int, rng: random.Random):
+    """Создает БД с size пользователями и рефералами (напрямую через sqlite3 — так быстрее)"""
+    path = seed_path(size)
+    os.makedirs(DATA_DIR, exist_ok=True)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    asyncio.run(_create_schema(path))
+
+    start = time.perf_counter()
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = OFF")
+    referrers = max(1, int(size * REFERRER_SHARE))
+    for first in range(1, size + 1, SEED_BATCH):
+        users, referrals = [], []
+        for user_id in range(first, min(first + SEED_BATCH, size + 1)):
+            games = rng.randint(0, 200)
+            wagered = games * rng.randint(1, 50)
+            code = None if rng.random() < NO_CODE_SHARE else f"B{user_id:07X}"
+            referrer_id = rng.randint(1, referrers) if user_id > referrers and rng.random() < REFERRED_SHARE else None
+            users.append((user_id, f"user{user_id}", rng.randint(0, 10_000), games, games // 2, wagered,
+                          rng.randint(-wagered, wagered), referrer_id, code))
+            if referrer_id:
+                referrals.append((referrer_id, user_id, "2025-01-01 00:00:00", True))
+        db.executemany("""
+            INSERT INTO users (user_id, username, balance, games_played, games_won, total_wagered, net_profit, referrer_id, referral_code)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, users)
+        db.executemany("INSERT INTO referrals (referrer_id, referred_id, created_at, bonus_paid) VALUES (?, ?, ?, ?)", referrals)
+        db.commit()
+    db.execute("""
+        UPDATE users SET
+            referrals_count = (SELECT COUNT(*) FROM referrals WHERE referrer_id = users.user_id),
+            referral_earnings = 25 * (SELECT COUNT(*) FROM referrals WHERE referrer_id = users.user_id)
+        WHERE user_id <= ?
+    """, (referrers,))
+    db.commit()
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.execute("ANALYZE")
+    db.close()
+    print(f"БД на {size} пользователей создана за {time.perf_counter() - start:.1f} сек.: {path}")
+
+# ==================== ОПЕРАЦИИ ====================
+
+def operations(size: int):
+    """Операция: (имя, фабрика корутины от rng, массовая ли). Массовые читают всю таблицу"""
+    import database
+    referrers = max(1, int(size * REFERRER_SHARE))
+    user = lambda rng: rng.randint(1, size)
+
+    async def iter_user_ids(rng):
+        # Бывшая get_all_user_ids: полный проход по таблице страницами
+        async for _ in database.iter_user_ids():
+            pass
+
+    return [
+        ("get_user_balance", lambda rng: database.get_user_balance(user(rng)), False),
+        ("update_user_stats", lambda rng: database.update_user_stats(user(rng), 10, rng.choice((0, 20))), False),
+        ("settle_bet", lambda rng: database.settle_bet(user(rng), "dice", 1, 6, rng.choice((0, 2))), False),
+        ("get_top_users", lambda rng: database.get_top_users(10), False),
+        ("get_user_rank", lambda rng: database.get_user_rank(user(rng)), False),
+        ("get_global_stats", lambda rng: database.get_global_stats(), False),
+        ("get_user_referrals", lambda rng: database.get_user_referrals(rng.randint(1, referrers)), False),
+        ("ensure_referral_code", lambda rng: database.ensure_referral_code(user(rng)), False),
+        ("load_leaderboard", lambda rng: database.load_leaderboard(), False),
+        ("iter_user_ids", iter_user_ids, True),
+    ]
+
+def _reset_caches():
+    import database
+    for cache in (database._balance_cache, database._known_users, database._referral_codes):
+        cache.clear()
+
+async def _measure(make_call, calls: int, concurrency: int, rng: random.Random) -> dict:
+    latencies = []
+
+    async def worker(count: int):
+        for _ in range(count):
+            start = time.perf_counter()
+            await make_call(rng)
+            latencies.append(time.perf_counter() - start)
+
+    _reset_caches()
+    per_worker, extra = divmod(calls, concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(per_worker + (i < extra)) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {"ops_per_sec": round(len(latencies) / elapsed, 1), **percentiles(latencies)}
+
+async def bench_size(size: int, args) -> dict:
+    import database
+    workdir, path = copy_seed(size, "casino_dbbench_")
+    await database.init_pool(path, readers=args.readers)
+    try:
+        # Как при старте бота: миграции схемы (закэшированная БД может быть старше кода)
+        # и загрузка рейтинга в память до замеров
+        await database.init_db()
+        await database.load_leaderboard()
+        database.start_bet_ledger()
+        results = {}
+        for name, make_call, bulk in operations(size):
+            if args.ops and name not in args.ops:
+                continue
+            calls = args.bulk_calls if bulk else args.calls
+            rng = random.Random(args.seed)
+            results[name] = {"serial": await _measure(make_call, calls, 1, rng)}
+            if not bulk:
+                results[name]["concurrent"] = await _measure(make_call, calls, args.concurrency, rng)
+            print_row(size, name, results[name])
+        await database.flush_bet_ledger()
+        return results
+    finally:
+        await database.close_pool()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+async def bench_all(args) -> dict:
+    # Один цикл событий на все размеры: журнал ставок database привязывается к циклу
+    return {str(size): await bench_size(size, args) for size in args.sizes}
+
+# ==================== ПРОВЕРКА ПЛАНОВ ====================
+
+def plan_checks(size: int):
+    """Вызовы всех функций database, выполняющих SQL; порядок важен (рейтинг загружается последним)"""
+    import database
+    user_id, new_user_id = size // 2, size + 1
+    payload = f"casino-deposit-{user_id}-check"
+    return [
+        ("get_top_users (без рейтинга)", lambda: database.get_top_users(10)),
+        ("get_user_rank (без рейтинга)", lambda: database.get_user_rank(user_id)),
+        ("add_user_if_not_exists", lambda: database.add_user_if_not_exists(new_user_id, "new_user")),
+        ("add_user_if_not_exists (смена имени)", lambda: database.add_user_if_not_exists(user_id, "renamed")),
+        ("get_user_balance", lambda: database.get_user_balance(user_id)),
+        ("update_user_balance", lambda: database.update_user_balance(user_id, 100, relative=True)),
+        ("update_user_stats", lambda: database.update_user_stats(user_id, 10, 20)),
+        ("settle_bet", lambda: database.settle_bet(user_id, "dice", 1, 6, 2)),
+        ("flush_bet_ledger", database.flush_bet_ledger),
+        ("get_user_bets", lambda: database.get_user_bets(user_id)),
+        ("get_game_stats", lambda: database.get_game_stats(["dice", "dart"])),
+        ("set_user_nickname", lambda: database.set_user_nickname(user_id, "nick")),
+        ("iter_user_id_batches", lambda: anext(database.iter_user_id_batches(100, ("active", "has_balance")))),
+        ("deactivate_users", lambda: database.deactivate_users([user_id])),
+        ("get_global_stats", database.get_global_stats),
+        ("reconcile_totals", database.reconcile_totals),
+        ("get_user_by_referral_code", lambda: database.get_user_by_referral_code("B0000001")),
+        ("register_referral", lambda: database.register_referral(1, new_user_id)),
+        ("get_user_referrals", lambda: database.get_user_referrals(1)),
+        ("get_user_referrals (страница)", lambda: database.get_user_referrals(1, cursor=size // 3)),
+        ("get_user_referrals (назад)", lambda: database.get_user_referrals(1, cursor=size // 3, backward=True)),
+        ("get_user_referral_info", lambda: database.get_user_referral_info(1)),
+        ("ensure_referral_code", lambda: database.ensure_referral_code(user_id)),
+        ("backfill_referral_codes", database.backfill_referral_codes),
+        ("create_invoice", lambda: database.create_invoice(payload, user_id, 100)),
+        ("is_pending_invoice", lambda: database.is_pending_invoice(payload, user_id, 100)),
+        ("credit_payment", lambda: database.credit_payment("check-charge", payload, user_id, 100)),
+        ("create_broadcast", lambda: database.create_broadcast("check", 1)),
+        ("save_broadcast_progress", lambda: database.save_broadcast_progress(1, user_id, 1, 0, 0)),
+        ("get_unfinished_broadcasts", database.get_unfinished_broadcasts),
+        ("finish_broadcast", lambda: database.finish_broadcast(1)),
+        ("load_leaderboard", database.load_leaderboard),
+    ]
+
+async def check_plans(size: int, args) -> list[str]:
+    import database
+    workdir, path = copy_seed(size, "casino_plans_")
+    failures = []
+    await database.init_pool(path, readers=args.readers)
+    try:
+        await database.init_db()
+        database.start_bet_ledger()
+        for name, call in plan_checks(size):
+            try:
+                await call()
+            except database.UnindexedScanError as e:
+                failures.append(f"{name}: {e}")
+        await database.flush_bet_ledger()
+    finally:
+        await database.close_pool()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\nПланы запросов на {size} пользователей:")
+    for sql, (details, scans) in database.get_query_plans().items():
+        if details:
+            print(f"{'!!' if scans else '  '} {' '.join(sql.split())}\n     {'; '.join(details)}")
+    return failures
+
+# ==================== ОТЧЕТ ====================
+
+def print_header():
+    print(f"\n{'размер':>8}  {'операция':<22} {'режим':<11} {'оп/сек':>10} {'p50 мс':>9} {'p95 мс':>9} {'p99 мс':>9}")
+
+def print_row(size: int, name: str, result: dict):
+    for mode, stats in result.items():
+        print(f"{size:>8}  {name:<22} {mode:<11} {stats['ops_per_sec']:>10} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+
+def compare(report: dict, baseline: dict, threshold: float | None) -> list[str]:
+    """Печатает изменения относительно эталона и возвращает список регрессий сверх threshold процентов"""
+    print(f"\nСравнение с эталоном {baseline.get('commit')} ({baseline.get('created_at')}):")
+    regressions = []
+    for size, results in report["results"].items():
+        for name, modes in results.items():
+            for mode, stats in modes.items():
+                old = baseline.get("results", {}).get(size, {}).get(name, {}).get(mode)
+                if not old:
+                    continue
+                line = (f"  {size:>8} {name:<22} {mode:<11} оп/сек {change(stats['ops_per_sec'], old['ops_per_sec']):>8}, "
+                        f"p95 {old['p95_ms']} -> {stats['p95_ms']} мс ({change(stats['p95_ms'], old['p95_ms'])})")
+                slower = old["p95_ms"] and (stats["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100
+                fewer = old["ops_per_sec"] and (old["ops_per_sec"] - stats["ops_per_sec"]) / old["ops_per_sec"] * 100
+                if threshold is not None and max(slower, fewer) > threshold:
+                    line += "  <-- регрессия"
+                    regressions.append(f"{size}/{name}/{mode}")
+                print(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--ops", nargs="+", help="только указанные операции")
+    parser.add_argument("--calls", type=int, default=2000, help="вызовов точечной операции на замер")
+    parser.add_argument("--bulk-calls", type=int, default=3, help="вызовов массовой операции на замер")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--readers", type=int, default=4, help="читателей в пуле (DB_READERS)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--reseed", action="store_true", help="пересоздать БД даже если они уже есть")
+    parser.add_argument("--output", help="куда сохранить JSON (по умолчанию benchmarks/results/)")
+    parser.add_argument("--save-baseline", metavar="NAME", help="сохранить результат как benchmarks/baselines/NAME.json")
+    parser.add_argument("--compare", metavar="FILE", help="сравнить с эталоном")
+    parser.add_argument("--threshold", type=float, help="допустимое ухудшение в процентах; выше — код выхода 1")
+    parser.add_argument("--check-plans", action="store_true", help="проверить планы запросов вместо замеров")
+    args = parser.parse_args()
+
+    use_repo_modules(**({"DB_STRICT_PLANS": "1"} if args.check_plans else {}))
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    for size in args.sizes:
+        if args.reseed or not os.path.exists(seed_path(size)):
+            seed(size, random.Random(args.seed))
+
+    if args.check_plans:
+        failures = asyncio.run(check_plans(max(args.sizes), args))
+        if failures:
+            print("\nПолный просмотр таблиц:\n" + "\n".join(failures))
+            sys.exit(1)
+        print("\nПолных просмотров таблиц нет.")
+        return
+
+    report = new_report({key: value for key, value in vars(args).items()
+                         if key in ("sizes", "ops", "calls", "bulk_calls", "concurrency", "readers", "seed")})
+    print_header()
+    report["results"] = asyncio.run(bench_all(args))
+    save_report(report, "db", args.output, args.save_baseline)
+
+    if args.compare:
+        regressions = compare(report, load_report(args.compare), args.threshold)
+        if regressions:
+            print(f"\nРегрессии сверх {args.threshold}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Локальная заглушка Telegram Bot API для нагрузочных тестов.
+
+Отвечает на методы, которые вызывает бот (getUpdates, sendMessage, editMessageText,
+sendDice, createInvoiceLink, ...), и отдает через getUpdates обновления, которые
+подкладывают синтетические игроки. Каждый вызов API передается в on_call, чтобы
+игроки могли реагировать на ответы бота.
+"""
+import asyncio
+import json
+import random
+import time
+from urllib.parse import parse_qsl
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Casino", "username": "casino_bench_bot"}
+
+# Число граней анимированных кубиков Telegram
+DICE_FACES = {"🎲": 6, "🎯": 6, "🎳": 6, "🏀": 5, "⚽": 5, "🎰": 64}
+
+def _parse_params(body: bytes, content_type: str) -> dict:
+    """PTB отправляет параметры формой: строки как есть, остальное — в JSON"""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    params = {}
+    for name, value in parse_qsl(body.decode(), keep_blank_values=True):
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+class FakeBotAPI:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, seed: int = 0, on_call=None):
+        self.host = host
+        self.port = port
+        self.on_call = on_call
+        self.random = random.Random(seed)
+        self.calls: dict[str, int] = {}
+        self._updates: list[dict] = []
+        self._update_id = 0
+        self._new_updates = asyncio.Event()
+        self._message_ids: dict[int, int] = {}
+        self._server: asyncio.base_events.Server | None = None
+        self._connections: dict[asyncio.StreamWriter, asyncio.Task] = {}
+
+    # ---------- Обновления от игроков ----------
+
+    def push_update(self, payload: dict) -> int:
+        """Ставит обновление в очередь getUpdates и возвращает его update_id"""
+        self._update_id += 1
+        self._updates.append({"update_id": self._update_id, **payload})
+        self._new_updates.set()
+        return self._update_id
+
+    def next_message_id(self, chat_id: int) -> int:
+        self._message_ids[chat_id] = self._message_ids.get(chat_id, 0) + 1
+        return self._message_ids[chat_id]
+
+    # ---------- Методы API ----------
+
+    def _message(self, chat_id: int, message_id: int | None = None, **fields) -> dict:
+        return {
+            "message_id": message_id or self.next_message_id(chat_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    async def _get_updates(self, params: dict):
+        offset = params.get("offset") or 0
+        # Подтвержденные ботом обновления больше не нужны
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout=params.get("timeout") or 0)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:params.get("limit") or 100]
+
+    async def call(self, method: str, params: dict):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getUpdates":
+            return await self._get_updates(params)
+
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            fields = {"text": params.get("text", "")}
+            if "reply_markup" in params:
+                fields["reply_markup"] = params["reply_markup"]
+            result = self._message(chat_id, params.get("message_id"), **fields)
+        elif method == "sendDice":
+            emoji = params.get("emoji", "🎲")
+            value = self.random.randint(1, DICE_FACES.get(emoji, 6))
+            result = self._message(chat_id, dice={"emoji": emoji, "value": value})
+        elif method == "createInvoiceLink":
+            result = f"https://t.me/$invoice/{params['payload']}"
+        else:
+            # answerCallbackQuery, deleteMessage, answerPreCheckoutQuery, deleteWebhook, ...
+            result = True
+
+        if self.on_call:
+            self.on_call(method, params, result)
+        return result
+
+    # ---------- HTTP ----------
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            # Висящие long polling запросы прерываем, иначе wait_closed их дождется
+            tasks = list(self._connections.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                method = target.rsplit("/", 1)[-1].split("?", 1)[0]
+                result = await self.call(method, _parse_params(body, headers.get("content-type", "")))
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n%s" % (len(payload), payload)
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
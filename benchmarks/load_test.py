@@ -0,0 +1,407 @@
+"""Нагрузочный тест бота без Telegram.
+
+Запускает настоящий main.main() (polling) против локальной заглушки Bot API
+(fake_bot_api.py) и гоняет N синтетических игроков по сценариям
+/start -> играть -> ставка -> еще раз / сменить ставку, пополнение, вывод,
+баланс/топ/правила.
+
+Отчет: обновлений в секунду, задержка ответа игроку (p50/p95/p99) по действиям,
+время обработчиков и время в БД по обработчикам. Результат сохраняется в JSON;
+с --save-baseline он становится эталоном, с --compare сравнивается с эталоном.
+
+Пример:
+    python benchmarks/load_test.py --users 200 --duration 30
+    python benchmarks/load_test.py --users 200 --duration 30 --save-baseline main
+    python benchmarks/load_test.py --users 200 --duration 30 --compare benchmarks/baselines/main.json
+"""
+import argparse
+import asyncio
+import contextvars
+import inspect
+import multiprocessing
+import os
+import random
+import re
+import signal
+import tempfile
+import time
+from collections import defaultdict
+from functools import wraps
+from common import change, load_report, new_report, percentiles, save_report, use_repo_modules
+
+PLAYER_ID_BASE = 100_000
+ADMIN_CHAT_ID = 1
+REPLY_TIMEOUT = 10
+BALANCE_RE = re.compile(r"баланс: <b>(\d+)</b>")
+
+# ==================== ИГРОКИ (процесс заглушки API) ====================
+
+def _buttons(params: dict) -> set[str]:
+    markup = params.get("reply_markup") or {}
+    return {button.get("callback_data") for row in markup.get("inline_keyboard", []) for button in row}
+
+def replied_with(*callback_data: str, method: str | None = None):
+    """Ожидание ответа бота: сообщение с одной из кнопок или вызов указанного метода"""
+    def predicate(api_method: str, params: dict) -> bool:
+        if method:
+            return api_method == method
+        return api_method in ("sendMessage", "editMessageText") and bool(_buttons(params) & set(callback_data))
+    return predicate
+
+class Player:
+    def __init__(self, api, stats: "PlayerStats", user_id: int, rng: random.Random):
+        self.api = api
+        self.stats = stats
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"Player{user_id}", "username": f"player{user_id}"}
+        self.rng = rng
+        self.balance = 0
+        self.invoice_payload: str | None = None
+        self._counter = 0
+        self._waiter = None
+
+    def _next_id(self) -> str:
+        self._counter += 1
+        return f"{self.user['id']}:{self._counter}"
+
+    def _chat(self) -> dict:
+        return {"id": self.user["id"], "type": "private"}
+
+    def _message(self, **fields) -> dict:
+        return {"message_id": self.api.next_message_id(self.user["id"]), "date": int(time.time()),
+                "chat": self._chat(), "from": self.user, **fields}
+
+    def text(self, text: str) -> dict:
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": self._message(**fields)}
+
+    def click(self, data: str, message: dict) -> dict:
+        return {"callback_query": {"id": self._next_id(), "from": self.user, "chat_instance": "bench",
+                                   "data": data, "message": message}}
+
+    def on_bot_call(self, method: str, params: dict, result):
+        if method == "createInvoiceLink":
+            self.invoice_payload = params["payload"]
+        text = params.get("text")
+        if isinstance(text, str) and (match := BALANCE_RE.search(text)):
+            self.balance = int(match.group(1))
+        if self._waiter and self._waiter[0](method, params):
+            predicate, future = self._waiter
+            self._waiter = None
+            if not future.done():
+                future.set_result(result)
+
+    async def act(self, label: str, update: dict, predicate):
+        """Отправляет обновление и ждет ответа бота; возвращает результат вызова API или None"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiter = (predicate, future)
+        start = time.perf_counter()
+        self.api.push_update(update)
+        self.stats.updates += 1
+        try:
+            result = await asyncio.wait_for(future, REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._waiter = None
+            self.stats.timeouts[label] += 1
+            return None
+        self.stats.latency[label].append(time.perf_counter() - start)
+        return result
+
+    # ---------- Сценарии; каждый возвращает сообщение с главным меню или None ----------
+
+    async def start(self):
+        return await self.act("start", self.text("/start"), replied_with("play"))
+
+    async def play_session(self, menu: dict):
+        games = await self.act("play", self.click("play", menu), replied_with("game_dice"))
+        if not games:
+            return None
+        game = self.rng.choice(("dice", "basketball", "football", "dart"))
+        if not await self.act("choose_game", self.click(f"game_{game}", games), replied_with(method="editMessageText")):
+            return None
+        after_game = ("post_game_play_again", "main_menu_from_nested")
+        result = await self.act("place_bet", self.text(str(self.rng.randint(1, 10))), replied_with(*after_game))
+        for _ in range(self.rng.randint(0, 3)):
+            if not result or "post_game_play_again" not in _buttons(result) or self.balance < 20:
+                break
+            if self.rng.random() < 0.7:
+                result = await self.act("play_again", self.click("post_game_play_again", result), replied_with(*after_game))
+            else:
+                prompt = await self.act("change_bet", self.click("post_game_change_bet", result), replied_with("main_menu_from_nested"))
+                if not prompt:
+                    return None
+                result = await self.act("change_bet_input", self.text(str(self.rng.randint(1, 10))), replied_with(*after_game))
+        if not result:
+            return None
+        back = "post_game_back_to_menu" if "post_game_back_to_menu" in _buttons(result) else "main_menu_from_nested"
+        return await self.act("back_to_menu", self.click(back, result), replied_with("play"))
+
+    async def deposit(self, menu: dict):
+        options = await self.act("deposit", self.click("deposit", menu), replied_with("deposit_1000"))
+        if not options:
+            return None
+        link = await self.act("deposit_amount", self.click("deposit_1000", options), replied_with("main_menu_from_nested"))
+        if not link or not self.invoice_payload:
+            return None
+        checkout = {"pre_checkout_query": {"id": self._next_id(), "from": self.user, "currency": "XTR",
+                                           "total_amount": 1000, "invoice_payload": self.invoice_payload}}
+        await self.act("pre_checkout", checkout, replied_with(method="answerPreCheckoutQuery"))
+        payment = {"currency": "XTR", "total_amount": 1000, "invoice_payload": self.invoice_payload,
+                   "telegram_payment_charge_id": f"bench-{self._next_id()}", "provider_payment_charge_id": ""}
+        await self.act("successful_payment", {"message": self._message(successful_payment=payment)}, replied_with(method="sendMessage"))
+        return await self.act("back_to_menu", self.click("main_menu_from_nested", link), replied_with("play"))
+
+    async def withdraw(self, menu: dict):
+        prompt = await self.act("withdraw", self.click("withdraw", menu), replied_with(method="editMessageText"))
+        if not prompt:
+            return None
+        if "main_menu_from_nested" not in _buttons(prompt):
+            prompt = await self.act("withdraw_amount", self.text("500"), replied_with("main_menu_from_nested"))
+            if not prompt:
+                return None
+        return await self.act("back_to_menu", self.click("main_menu_from_nested", prompt), replied_with("play"))
+
+    async def browse(self, menu: dict):
+        page = self.rng.choice(("balance", "top", "rules"))
+        shown = await self.act(page, self.click(page, menu), replied_with("back_to_start"))
+        if not shown:
+            return None
+        return await self.act("start_over", self.click("back_to_start", shown), replied_with("play"))
+
+    async def run(self, deadline: float, think_time: float):
+        menu = None
+        while time.monotonic() < deadline:
+            if menu is None:
+                menu = await self.start()
+                continue
+            if self.balance < 100:
+                scenario = self.deposit
+            else:
+                roll = self.rng.random()
+                scenario = (self.play_session if roll < 0.7 else
+                            self.withdraw if roll < 0.8 and self.balance >= 600 else
+                            self.browse)
+            menu = await scenario(menu)
+            if think_time:
+                await asyncio.sleep(self.rng.expovariate(1 / think_time))
+
+class PlayerStats:
+    def __init__(self):
+        self.updates = 0
+        self.latency: dict[str, list[float]] = defaultdict(list)
+        self.timeouts: dict[str, int] = defaultdict(int)
+
+async def _drive_players(args, parent_pid: int, ready, done, results):
+    from fake_bot_api import FakeBotAPI
+
+    players: dict[int, Player] = {}
+
+    def route(method: str, params: dict, result):
+        user_id = params.get("chat_id")
+        if user_id is None:
+            # Ответы на callback и pre-checkout адресуются по id запроса: "<user_id>:<n>"
+            query_id = params.get("callback_query_id") or params.get("pre_checkout_query_id")
+            if query_id:
+                user_id = int(str(query_id).split(":")[0])
+            elif method == "createInvoiceLink":
+                user_id = int(params["payload"].split("-")[2])
+        player = players.get(user_id) if isinstance(user_id, int) else None
+        if player:
+            player.on_bot_call(method, params, result)
+
+    api = FakeBotAPI(port=args.port, seed=args.seed, on_call=route)
+    await api.start()
+    ready.set()
+
+    stats = PlayerStats()
+    master_rng = random.Random(args.seed)
+    for i in range(args.users):
+        user_id = PLAYER_ID_BASE + i
+        players[user_id] = Player(api, stats, user_id, random.Random(master_rng.random()))
+
+    # Ждем, пока бот начнет опрашивать getUpdates
+    while not api.calls.get("getUpdates"):
+        await asyncio.sleep(0.05)
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(player.run(deadline, args.think_ms / 1000) for player in players.values()))
+    duration = time.monotonic() - started
+
+    results.put({
+        "duration_s": round(duration, 3),
+        "updates": stats.updates,
+        "updates_per_sec": round(stats.updates / duration, 1),
+        "reply_latency": {label: percentiles(values) for label, values in sorted(stats.latency.items())},
+        "timeouts": dict(stats.timeouts),
+        "api_calls": dict(sorted(api.calls.items())),
+    })
+    # Останавливаем бота и продолжаем отвечать на его запросы, пока он не завершится
+    os.kill(parent_pid, signal.SIGINT)
+    while not done.is_set():
+        await asyncio.sleep(0.1)
+    await api.stop()
+
+def _players_process(args, parent_pid: int, ready, done, results):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_drive_players(args, parent_pid, ready, done, results))
+
+# ==================== ИЗМЕРЕНИЯ В ПРОЦЕССЕ БОТА ====================
+
+_current_handler: contextvars.ContextVar[dict | None] = contextvars.ContextVar("bench_handler", default=None)
+_handler_times: dict[str, list[tuple[float, float]]] = defaultdict(list)
+
+def _timed_handler(callback):
+    @wraps(callback)
+    async def wrapper(update, context):
+        record = {"db": 0.0, "in_db": False}
+        token = _current_handler.set(record)
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            _handler_times[callback.__name__].append((time.perf_counter() - start, record["db"]))
+            _current_handler.reset(token)
+    wrapper._bench_timed = True
+    return wrapper
+
+def _timed_db(function):
+    @wraps(function)
+    async def wrapper(*args, **kwargs):
+        record = _current_handler.get()
+        if record is None or record["in_db"]:
+            return await function(*args, **kwargs)
+        record["in_db"] = True
+        start = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            record["db"] += time.perf_counter() - start
+            record["in_db"] = False
+    return wrapper
+
+def _instrument_handlers(handlers):
+    from telegram.ext import ConversationHandler
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            _instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                _instrument_handlers(state_handlers)
+            _instrument_handlers(handler.fallbacks)
+        elif not getattr(handler.callback, "_bench_timed", False):
+            handler.callback = _timed_handler(handler.callback)
+
+def _instrument_bot():
+    """Оборачивает обработчики и публичные функции database для замера времени"""
+    import database
+    import main as bot_main
+
+    for name, function in list(vars(database).items()):
+        if not name.startswith("_") and inspect.iscoroutinefunction(function) and function.__module__ == database.__name__:
+            setattr(database, name, _timed_db(function))
+
+    build_application = bot_main.build_application
+
+    def instrumented_build_application(*args, **kwargs):
+        application = build_application(*args, **kwargs)
+        for group_handlers in application.handlers.values():
+            _instrument_handlers(group_handlers)
+        return application
+
+    bot_main.build_application = instrumented_build_application
+
+def _handler_report() -> dict:
+    report = {}
+    for name, samples in sorted(_handler_times.items()):
+        latencies = [latency for latency, _ in samples]
+        db_times = [db for _, db in samples]
+        report[name] = {
+            **percentiles(latencies),
+            "db_mean_ms": round(sum(db_times) / len(db_times) * 1000, 3),
+            "db_p95_ms": percentiles(db_times)["p95_ms"],
+        }
+    return report
+
+# ==================== ОТЧЕТ ====================
+
+def compare(report: dict, baseline: dict):
+    """Печатает изменения относительно эталона: пропускную способность и p95 по обработчикам"""
+    print(f"\nСравнение с эталоном {baseline.get('commit')} ({baseline.get('created_at')}):")
+    print(f"  обновлений/сек: {baseline['updates_per_sec']} -> {report['updates_per_sec']} "
+          f"({change(report['updates_per_sec'], baseline['updates_per_sec'])})")
+    for name, stats in report["handlers"].items():
+        old = baseline.get("handlers", {}).get(name)
+        if old and old.get("count") and stats.get("count"):
+            print(f"  {name}: p95 {old['p95_ms']} -> {stats['p95_ms']} мс ({change(stats['p95_ms'], old['p95_ms'])}), "
+                  f"БД {old['db_mean_ms']} -> {stats['db_mean_ms']} мс")
+
+def print_report(report: dict):
+    print(f"\nИгроков: {report['config']['users']}, длительность: {report['duration_s']} сек.")
+    print(f"Обновлений: {report['updates']} ({report['updates_per_sec']}/сек)")
+    if report["timeouts"]:
+        print(f"Без ответа: {report['timeouts']}")
+    print("\nЗадержка ответа игроку, мс (p50 / p95 / p99):")
+    for label, stats in report["reply_latency"].items():
+        print(f"  {label:<20} {stats['count']:>7}  {stats['p50_ms']:>8} / {stats['p95_ms']:>8} / {stats['p99_ms']:>8}")
+    print("\nОбработчики, мс (p50 / p95 / p99, среднее время в БД):")
+    for name, stats in report["handlers"].items():
+        print(f"  {name:<32} {stats['count']:>7}  {stats['p50_ms']:>8} / {stats['p95_ms']:>8} / {stats['p99_ms']:>8}  БД {stats['db_mean_ms']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30, help="секунд нагрузки")
+    parser.add_argument("--think-ms", type=float, default=0, help="средняя пауза игрока между сценариями")
+    parser.add_argument("--dice-delay", type=float, default=0, help="пауза анимации кубика (в боте 3.5 сек.)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--db", help="файл БД (по умолчанию новая БД во временном каталоге)")
+    parser.add_argument("--output", help="куда сохранить JSON (по умолчанию benchmarks/results/)")
+    parser.add_argument("--save-baseline", metavar="NAME", help="сохранить результат как benchmarks/baselines/NAME.json")
+    parser.add_argument("--compare", metavar="FILE", help="сравнить с эталоном")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="casino_bench_")
+    use_repo_modules(
+        BOT_API_URL=f"http://127.0.0.1:{args.port}",
+        BOT_MODE="polling",
+        BOT_WORKERS="1",
+        ADMIN_CHAT_ID=str(ADMIN_CHAT_ID),
+        DB_PATH=args.db or os.path.join(workdir, "casino_bot.db"),
+        PERSISTENCE_PATH=os.path.join(workdir, "bot_state.db"),
+    )
+
+    import logging
+    import handlers
+    import main as bot_main
+    logging.getLogger().setLevel(logging.WARNING)
+    handlers.DICE_ANIMATION_SECONDS = args.dice_delay
+    _instrument_bot()
+
+    context = multiprocessing.get_context("spawn")
+    ready, done, results = context.Event(), context.Event(), context.Queue()
+    players = context.Process(target=_players_process, args=(args, os.getpid(), ready, done, results), name="bench-players")
+    players.start()
+    if not ready.wait(30):
+        players.terminate()
+        raise SystemExit("Заглушка Bot API не запустилась")
+
+    try:
+        bot_main.main()
+    finally:
+        done.set()
+    player_report = results.get(timeout=60)
+    players.join(30)
+
+    report = {
+        **new_report({key: value for key, value in vars(args).items() if key in ("users", "duration", "think_ms", "dice_delay", "seed")}),
+        **player_report,
+        "handlers": _handler_report(),
+    }
+    print_report(report)
+    save_report(report, "load", args.output, args.save_baseline)
+    if args.compare:
+        compare(report, load_report(args.compare))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from config import BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_BATCH_SIZE
+import database
+
+logger = logging.getLogger(__name__)
+
+SENT, FAILED, BLOCKED = "sent", "failed", "blocked"
+
+class TokenBucket:
+    """Ограничитель частоты: в среднем rate событий в секунду, не больше burst подряд"""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, после RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+# Лимит Telegram общий для бота, поэтому ограничитель один на все рассылки
+_bucket = TokenBucket(BROADCAST_RATE)
+_tasks: set[asyncio.Task] = set()
+
+async def send_message_to_user(bot, user_id: int, message: str) -> str:
+    while True:
+        await _bucket.acquire()
+        try:
+            await bot.send_message(chat_id=user_id, text=message, parse_mode='HTML')
+            return SENT
+        except RetryAfter as e:
+            delay = e.retry_after
+            if isinstance(delay, timedelta):
+                delay = delay.total_seconds()
+            logger.warning(f"Flood control при рассылке, пауза {delay} сек.")
+            _bucket.pause(delay)
+        except Forbidden:
+            return BLOCKED
+        except TelegramError as e:
+            logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+            return FAILED
+
+async def run_broadcast(bot, broadcast: dict) -> dict:
+    """Рассылает сообщение всем активным пользователям, начиная с сохраненной позиции.
+
+    Прогресс сохраняется после каждой страницы, поэтому прерванная рассылка
+    продолжается с первой неподтвержденной страницы.
+    """
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    counters = {SENT: broadcast['sent'], FAILED: broadcast['failed'], BLOCKED: broadcast['blocked']}
+    last_user_id = broadcast['last_user_id']
+
+    async def send_limited(user_id: int) -> str:
+        async with semaphore:
+            return await send_message_to_user(bot, user_id, broadcast['message'])
+
+    async for user_ids in database.iter_user_id_batches(BROADCAST_BATCH_SIZE, where="active", start_after=last_user_id):
+        results = await asyncio.gather(*(send_limited(user_id) for user_id in user_ids))
+        for result in results:
+            counters[result] += 1
+        await database.deactivate_users([user_id for user_id, result in zip(user_ids, results) if result == BLOCKED])
+
+        last_user_id = user_ids[-1]
+        await database.save_broadcast_progress(broadcast['id'], last_user_id, counters[SENT], counters[FAILED], counters[BLOCKED])
+
+    await database.finish_broadcast(broadcast['id'])
+    return counters
+
+async def _run_and_report(bot, broadcast: dict):
+    start_time = time.monotonic()
+    try:
+        counters = await run_broadcast(bot, broadcast)
+    except asyncio.CancelledError:
+        logger.info(f"Рассылка #{broadcast['id']} приостановлена, будет продолжена при следующем запуске.")
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка рассылки #{broadcast['id']}: {e}")
+        await _report_failure(bot, broadcast, e)
+        return
+
+    duration = time.monotonic() - start_time
+    logger.info(f"Рассылка #{broadcast['id']} завершена: {counters}")
+    if broadcast['chat_id']:
+        await bot.send_message(
+            chat_id=broadcast['chat_id'],
+            text=(f"✅ Рассылка #{broadcast['id']} завершена за {duration:.2f} сек.\n"
+                  f"Успешно отправлено: {counters[SENT]}\n"
+                  f"Не удалось отправить: {counters[FAILED]}\n"
+                  f"Заблокировали бота: {counters[BLOCKED]}")
+        )
+
+async def _report_failure(bot, broadcast: dict, error: Exception):
+    """Помечает рассылку как failed, чтобы она не перезапускалась, и сообщает администратору"""
+    progress = broadcast
+    try:
+        progress = await database.finish_broadcast(broadcast['id'], 'failed') or broadcast
+    except Exception as e:
+        logger.error(f"Не удалось отметить рассылку #{broadcast['id']} как прерванную: {e}")
+    if not broadcast['chat_id']:
+        return
+    try:
+        await bot.send_message(
+            chat_id=broadcast['chat_id'],
+            text=(f"❌ Рассылка #{broadcast['id']} прервана ошибкой: {error}\n"
+                  f"Успешно отправлено: {progress['sent']}\n"
+                  f"Не удалось отправить: {progress['failed']}\n"
+                  f"Заблокировали бота: {progress['blocked']}")
+        )
+    except TelegramError as e:
+        logger.error(f"Не удалось сообщить об ошибке рассылки #{broadcast['id']}: {e}")
+
+def start_broadcast(bot, broadcast: dict) -> asyncio.Task:
+    """Запускает рассылку в фоне"""
+    task = asyncio.create_task(_run_and_report(bot, broadcast), name=f"broadcast_{broadcast['id']}")
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+async def resume_broadcasts(bot):
+    """Продолжает рассылки, прерванные остановкой бота"""
+    for broadcast in await database.get_unfinished_broadcasts():
+        logger.info(f"Продолжаем рассылку #{broadcast['id']} с пользователя {broadcast['last_user_id']}.")
+        start_broadcast(bot, broadcast)
+
+async def stop_broadcasts():
+    """Прерывает активные рассылки; прогресс уже сохранен в БД"""
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
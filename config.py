@@ -1,4 +1,5 @@
 import os
+import secrets
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,6 +11,78 @@ ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
 if not TELEGRAM_TOKEN:
     raise ValueError("Необходимо указать TELEGRAM_TOKEN в .env файле")
 
+# Адрес Bot API: свой сервер telegram-bot-api или локальная заглушка для нагрузочных тестов
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org").rstrip("/")
+
 MIN_BET = int(os.getenv("MIN_BET", 1))
 MAX_BET = int(os.getenv("MAX_BET", 100000))
-MIN_WITHDRAWAL = int(os.getenv("MIN_WITHDRAWAL", 500))
\ No newline at end of file
+MIN_WITHDRAWAL = int(os.getenv("MIN_WITHDRAWAL", 500))
+
+DB_PATH = os.getenv("DB_PATH", "casino_bot.db")
+DB_READERS = int(os.getenv("DB_READERS", 4))
+
+# Профиль хранения SQLite: safe — fsync на каждый commit, balanced — fsync только при checkpoint WAL
+DB_DURABILITY = os.getenv("DB_DURABILITY", "balanced")
+if DB_DURABILITY not in ("safe", "balanced"):
+    raise ValueError(f"DB_DURABILITY должен быть safe или balanced, а не {DB_DURABILITY!r}")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", {"safe": "FULL", "balanced": "NORMAL"}[DB_DURABILITY])
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", 65536))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 256 * 1024 * 1024))
+DB_TEMP_STORE = os.getenv("DB_TEMP_STORE", "MEMORY")
+DB_CHECKPOINT_INTERVAL = float(os.getenv("DB_CHECKPOINT_INTERVAL", 60))
+# Запросы дольше DB_SLOW_QUERY_MS пишутся в лог (0 — выключено); DB_STRICT_PLANS=1 запрещает
+# полный просмотр таблиц и индексов, не помеченный как намеренный (для проверки на большой БД)
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", 100))
+DB_STRICT_PLANS = os.getenv("DB_STRICT_PLANS", "0").lower() in ("1", "true", "yes")
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", 10000))
+KNOWN_USERS_CACHE_SIZE = int(os.getenv("KNOWN_USERS_CACHE_SIZE", 100000))
+REFERRAL_CODE_CACHE_SIZE = int(os.getenv("REFERRAL_CODE_CACHE_SIZE", 10000))
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 256))
+# Сколько лучших игроков рейтинг держит в памяти (показываются первые 10)
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", 100))
+
+# Журнал ставок пишется пакетами: по N записей или раз в T миллисекунд
+BET_LEDGER_BATCH_SIZE = int(os.getenv("BET_LEDGER_BATCH_SIZE", 500))
+BET_LEDGER_FLUSH_MS = int(os.getenv("BET_LEDGER_FLUSH_MS", 200))
+
+# Рассылка: общий лимит Telegram ~30 сообщений/сек
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 200))
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+# Путь, на который Telegram присылает обновления
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Публичный адрес для setWebhook; без него сервер принимает обновления только локально
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Заголовок X-Telegram-Bot-Api-Secret-Token. С публичным адресом он обязателен, иначе кто угодно
+# пришлет поддельное обновление (в том числе об оплате): если не задан, генерируется при запуске
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN") or (secrets.token_urlsafe(32) if WEBHOOK_URL else None)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+# Открытых соединений сверх этого сервер не принимает; медленный клиент отключается через WEBHOOK_READ_TIMEOUT секунд
+WEBHOOK_MAX_OPEN_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_OPEN_CONNECTIONS", 200))
+WEBHOOK_READ_TIMEOUT = float(os.getenv("WEBHOOK_READ_TIMEOUT", 10))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+
+# Число процессов-обработчиков; при BOT_WORKERS > 1 обновления распределяются по user_id % BOT_WORKERS
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 1))
+# Как часто процесс перечитывает топ рейтинга из БД, чтобы увидеть изменения других процессов
+LEADERBOARD_REFRESH_INTERVAL = float(os.getenv("LEADERBOARD_REFRESH_INTERVAL", 30))
+
+# Состояние диалогов и user_data (отдельный файл SQLite, у каждого шарда свой)
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "bot_state.db")
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", 10))
+
+# Метрики в формате Prometheus на http://METRICS_LISTEN:METRICS_PORT/metrics (0 — выключено);
+# при нескольких процессах шард N слушает METRICS_PORT + N
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+
+# Профилирование по команде /profile [секунд]
+PROFILE_DEFAULT_SECONDS = float(os.getenv("PROFILE_DEFAULT_SECONDS", 30))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 300))
@@ -1,11 +1,557 @@
 import aiosqlite
+import asyncio
 import logging
+import re
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from config import (
+    DB_PATH, DB_READERS, DB_SYNCHRONOUS, DB_JOURNAL_MODE, DB_BUSY_TIMEOUT_MS, DB_CACHE_SIZE_KB,
+    DB_MMAP_SIZE, DB_TEMP_STORE, DB_CHECKPOINT_INTERVAL, DB_SLOW_QUERY_MS, DB_STRICT_PLANS,
+    BALANCE_CACHE_SIZE, KNOWN_USERS_CACHE_SIZE, REFERRAL_CODE_CACHE_SIZE, BET_LEDGER_BATCH_SIZE, BET_LEDGER_FLUSH_MS,
+    LEADERBOARD_SIZE,
+)
+from leaderboard import Leaderboard
+import metrics
 
 logger = logging.getLogger(__name__)
-DB_NAME = "casino_bot.db"
+DB_NAME = DB_PATH
+
+# ==================== ВЫПОЛНЕНИЕ ЗАПРОСОВ ====================
+
+class UnindexedScanError(RuntimeError):
+    """Запрос просматривает таблицу или индекс целиком (в режиме DB_STRICT_PLANS)"""
+
+# Планы запросов: SQL -> (строки EXPLAIN QUERY PLAN, строки с полным просмотром)
+_query_plans: dict[str, tuple[list[str], list[str]]] = {}
+_EXPLAINED_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+# Любой SCAN, в том числе по индексу (USING INDEX / USING COVERING INDEX), и сортировка во временном B-дереве
+_TABLE_SCAN = re.compile(r"^(SCAN (?!CONSTANT ROW$)|USE TEMP B-TREE)")
+
+def _compact_sql(sql: str) -> str:
+    return " ".join(sql.split())
+
+def _params_shape(params) -> str:
+    """Типы параметров без значений: (int, str[8], NoneType)"""
+    if params is None:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: {_value_shape(value)}" for key, value in params.items()) + "}"
+    return "(" + ", ".join(_value_shape(value) for value in params) + ")"
+
+def _value_shape(value) -> str:
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+def get_query_plans() -> dict[str, tuple[list[str], list[str]]]:
+    return dict(_query_plans)
+
+async def _explain(db: aiosqlite.Connection, sql: str, parameters) -> tuple[list[str], list[str]] | None:
+    """План запроса и его строки с полным просмотром; None — объяснить пока не удалось"""
+    if not sql.lstrip().upper().startswith(_EXPLAINED_STATEMENTS):
+        return [], []
+    if parameters is None and "?" in sql:
+        # executemany без строк: объяснить не на чем, попробуем в следующий раз
+        return None
+    try:
+        cursor = await db.execute(f"EXPLAIN QUERY PLAN {sql}", parameters if parameters is not None else ())
+        details = [row[3] for row in await cursor.fetchall()]
+    except aiosqlite.Error as e:
+        # Например, таблица еще не создана на этом соединении: план не запоминаем
+        logger.debug(f"Не удалось получить план запроса {_compact_sql(sql)}: {e}")
+        return None
+    return details, [detail for detail in details if _TABLE_SCAN.match(detail)]
+
+def _remember_plan(sql: str, plan: tuple[list[str], list[str]], scan_ok: bool):
+    _query_plans[sql] = plan
+    if plan[1] and not scan_ok:
+        logger.warning(f"Полный просмотр ({'; '.join(plan[1])}): {_compact_sql(sql)}")
+
+class TracedConnection:
+    """Соединение aiosqlite, через которое проходят все запросы database.py.
+
+    При первом выполнении каждого текста SQL сохраняет EXPLAIN QUERY PLAN и
+    предупреждает о полном просмотре таблицы или индекса, если он не помечен
+    scan_ok=True (в режиме DB_STRICT_PLANS — бросает UnindexedScanError). Писатель
+    держит замок записи, поэтому его запросы объясняет отдельное соединение пула
+    (planner) в фоне; в режиме DB_STRICT_PLANS план дожидается перед запросом.
+    Запросы дольше DB_SLOW_QUERY_MS, включая чтение результата, пишутся в лог
+    с формой параметров.
+    """
+
+    def __init__(self, db: aiosqlite.Connection, planner: "QueryPlanner | None" = None):
+        self._db = db
+        self._planner = planner
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    async def execute(self, sql: str, parameters=None, *, scan_ok: bool = False):
+        await self._check_plan(sql, parameters, scan_ok)
+        start = time.perf_counter()
+        cursor = await (self._db.execute(sql, parameters) if parameters is not None else self._db.execute(sql))
+        return TracedCursor(cursor, sql, _params_shape(parameters), time.perf_counter() - start)
+
+    async def executemany(self, sql: str, parameters, *, scan_ok: bool = False):
+        parameters = list(parameters)
+        await self._check_plan(sql, parameters[0] if parameters else None, scan_ok)
+        start = time.perf_counter()
+        cursor = await self._db.executemany(sql, parameters)
+        shape = f"{len(parameters)} x {_params_shape(parameters[0]) if parameters else '()'}"
+        return TracedCursor(cursor, sql, shape, time.perf_counter() - start)
+
+    async def _check_plan(self, sql: str, parameters, scan_ok: bool):
+        plan = _query_plans.get(sql)
+        if plan is None:
+            if self._planner is None:
+                plan = await _explain(self._db, sql, parameters)
+                if plan is not None:
+                    _remember_plan(sql, plan, scan_ok)
+            elif DB_STRICT_PLANS:
+                plan = await self._planner.explain(sql, parameters, scan_ok)
+            else:
+                self._planner.explain_later(sql, parameters, scan_ok)
+            if plan is None:
+                return
+        if plan[1] and not scan_ok and DB_STRICT_PLANS:
+            raise UnindexedScanError(f"Полный просмотр ({'; '.join(plan[1])}): {_compact_sql(sql)} | {'; '.join(plan[0])}")
+
+class QueryPlanner:
+    """Строит планы запросов писателя на собственном соединении, не занимая замок записи"""
+
+    def __init__(self, db: aiosqlite.Connection):
+        self._db = db
+        self._lock = asyncio.Lock()
+        self._pending: set[str] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    async def explain(self, sql: str, parameters, scan_ok: bool) -> tuple[list[str], list[str]] | None:
+        async with self._lock:
+            plan = _query_plans.get(sql)
+            if plan is None:
+                plan = await _explain(self._db, sql, parameters)
+                if plan is not None:
+                    _remember_plan(sql, plan, scan_ok)
+            return plan
+
+    def explain_later(self, sql: str, parameters, scan_ok: bool):
+        if sql in self._pending:
+            return
+        self._pending.add(sql)
+        task = asyncio.create_task(self._explain_later(sql, parameters, scan_ok), name="explain_query_plan")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _explain_later(self, sql: str, parameters, scan_ok: bool):
+        try:
+            await self.explain(sql, parameters, scan_ok)
+        finally:
+            self._pending.discard(sql)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+class TracedCursor:
+    """Курсор, досчитывающий время запроса при чтении результата"""
+
+    def __init__(self, cursor: aiosqlite.Cursor, sql: str, shape: str, elapsed: float):
+        self._cursor = cursor
+        self._sql = sql
+        self._shape = shape
+        self._elapsed = elapsed
+        self._logged = False
+        metrics.registry.inc("bot_db_queries_total")
+        self._check_slow()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _check_slow(self):
+        if DB_SLOW_QUERY_MS and not self._logged and self._elapsed * 1000 > DB_SLOW_QUERY_MS:
+            self._logged = True
+            metrics.registry.inc("bot_db_slow_queries_total")
+            logger.warning(f"Медленный запрос {self._elapsed * 1000:.0f} мс, параметры {self._shape}: {_compact_sql(self._sql)}")
+
+    async def _timed(self, fetch):
+        start = time.perf_counter()
+        try:
+            return await fetch
+        finally:
+            self._elapsed += time.perf_counter() - start
+            self._check_slow()
+
+    async def fetchone(self):
+        return await self._timed(self._cursor.fetchone())
+
+    async def fetchmany(self, size: int | None = None):
+        return await self._timed(self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany())
+
+    async def fetchall(self):
+        return await self._timed(self._cursor.fetchall())
+
+# ==================== ПУЛ СОЕДИНЕНИЙ ====================
+
+# Выполняются на каждом соединении пула сразу после открытия (настраиваются в config.py)
+CONNECTION_PRAGMAS = (
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+    f"PRAGMA journal_mode = {DB_JOURNAL_MODE}",
+    f"PRAGMA synchronous = {DB_SYNCHRONOUS}",
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size = {DB_MMAP_SIZE}",
+    f"PRAGMA temp_store = {DB_TEMP_STORE}",
+)
+
+class ConnectionPool:
+    """Постоянные соединения с БД: один писатель и фиксированное число читателей"""
+
+    def __init__(self, db_name: str, readers: int):
+        self.db_name = db_name
+        self.size = max(1, readers)
+        self._writer: TracedConnection | None = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue[TracedConnection] = asyncio.Queue(maxsize=self.size)
+        self._all: list[aiosqlite.Connection] = []
+        self._planner: QueryPlanner | None = None
+        self._checkpoint_task: asyncio.Task | None = None
+
+    async def _connect_raw(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.db_name)
+        db.row_factory = aiosqlite.Row
+        for pragma in CONNECTION_PRAGMAS:
+            await db.execute(pragma)
+        self._all.append(db)
+        return db
+
+    async def _connect(self, planner: QueryPlanner | None = None) -> TracedConnection:
+        return TracedConnection(await self._connect_raw(), planner)
+
+    async def open(self):
+        self._planner = QueryPlanner(await self._connect_raw())
+        self._writer = await self._connect(self._planner)
+        for _ in range(self.size):
+            self._readers.put_nowait(await self._connect())
+        if DB_JOURNAL_MODE.upper() == "WAL" and DB_CHECKPOINT_INTERVAL > 0:
+            checkpointer = await self._connect_raw()
+            self._checkpoint_task = asyncio.create_task(
+                self._checkpoint_loop(checkpointer, DB_CHECKPOINT_INTERVAL), name="wal_checkpoint"
+            )
+        logger.info(f"Пул соединений открыт: 1 писатель, {self.size} читателей ({self.db_name}, synchronous={DB_SYNCHRONOUS}).")
+
+    async def _checkpoint_loop(self, db: aiosqlite.Connection, interval: float):
+        """Периодически переносит WAL в основной файл, чтобы журнал не разрастался.
+
+        PASSIVE не ждет читателей и писателей, поэтому выполняется на своем
+        соединении без замка записи.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                cursor = await db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+                busy, wal_pages, checkpointed = await cursor.fetchone()
+                logger.debug(f"WAL checkpoint: {checkpointed}/{wal_pages} страниц (busy={busy}).")
+            except Exception as e:
+                logger.error(f"Ошибка WAL checkpoint: {e}")
+
+    async def close(self):
+        if self._checkpoint_task:
+            self._checkpoint_task.cancel()
+            await asyncio.gather(self._checkpoint_task, return_exceptions=True)
+            self._checkpoint_task = None
+        if self._planner:
+            await self._planner.close()
+            self._planner = None
+        for db in self._all:
+            await db.close()
+        self._all.clear()
+        self._writer = None
+        logger.info("Пул соединений закрыт.")
+
+    @asynccontextmanager
+    async def reader(self):
+        """Выдает свободное соединение для чтения"""
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Выдает единственное соединение для записи; незакоммиченное при ошибке откатывается"""
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+_pool: ConnectionPool | None = None
+
+async def init_pool(db_name: str = DB_NAME, readers: int = DB_READERS):
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(db_name, readers)
+        await _pool.open()
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+def _get_pool() -> ConnectionPool:
+    if _pool is None:
+        raise RuntimeError("Пул соединений не инициализирован: вызовите database.init_pool()")
+    return _pool
+
+def _reader():
+    return _get_pool().reader()
+
+def _writer():
+    return _get_pool().writer()
+
+# ==================== КЭШ БАЛАНСОВ ====================
+
+class LRUCache:
+    """Ограниченный LRU-кэш со счетчиками попаданий и промахов.
+
+    put/pop вызываются писателем после commit и увеличивают version; fill
+    заполняет кэш прочитанным значением, только если с момента чтения version
+    не менялась — так устаревшее чтение не перезапишет свежую запись.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return key in self._data
+
+    def get(self, key):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _store(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def put(self, key, value):
+        self.version += 1
+        self._store(key, value)
+
+    def pop(self, key):
+        self.version += 1
+        self._data.pop(key, None)
+
+    def fill(self, key, value, version: int):
+        if version == self.version:
+            self._store(key, value)
+
+    def clear(self):
+        self.version += 1
+        self._data.clear()
+
+_balance_cache = LRUCache(BALANCE_CACHE_SIZE)
+# user_id -> username уже записанных активных пользователей: повторный /start без изменений не пишет в БД
+_known_users = LRUCache(KNOWN_USERS_CACHE_SIZE)
+# Реферальный код пользователя не меняется, поэтому кэшируется без сброса
+_referral_codes = LRUCache(REFERRAL_CODE_CACHE_SIZE)
+leaderboard = Leaderboard(LEADERBOARD_SIZE)
+
+# При запуске несколькими процессами (sharding.py) каждый кэширует балансы только своих
+# пользователей, а об изменении чужого баланса сообщает процессу-владельцу
+_shard: tuple[int, int] | None = None
+_notify_owner = None
+
+def configure_shard(index: int, count: int, notify_owner) -> None:
+    """Включает режим шарда: notify_owner(user_id) вызывается при изменении чужого баланса"""
+    global _shard, _notify_owner
+    _shard = (index, count)
+    _notify_owner = notify_owner
+
+def owns_user(user_id: int) -> bool:
+    return _shard is None or user_id % _shard[1] == _shard[0]
+
+def forget_user(user_id: int) -> None:
+    """Сбрасывает закэшированные данные пользователя, измененного другим процессом"""
+    _balance_cache.pop(user_id)
+    _known_users.pop(user_id)
+
+def _balance_changed(user_id: int, row) -> None:
+    """Записывает в кэш и рейтинг баланс, возвращенный RETURNING balance (вызывать после commit)"""
+    if row and leaderboard.loaded:
+        leaderboard.update(user_id, row[0])
+    if not owns_user(user_id):
+        _notify_owner(user_id)
+    elif row:
+        _balance_cache.put(user_id, row[0])
+    else:
+        _balance_cache.pop(user_id)
+
+def get_cache_stats() -> dict:
+    total = _balance_cache.hits + _balance_cache.misses
+    return {
+        "size": len(_balance_cache),
+        "max_size": _balance_cache.maxsize,
+        "hits": _balance_cache.hits,
+        "misses": _balance_cache.misses,
+        "hit_rate": _balance_cache.hits / total if total else 0.0,
+    }
+
+# ==================== ЖУРНАЛ СТАВОК ====================
+
+class BetLedger:
+    """Пакетная запись ставок в таблицу bets.
+
+    record() только кладет запись в очередь; фоновая задача пишет накопленное
+    одной транзакцией, как только набралось batch_size записей или прошло
+    flush_ms миллисекунд с первой записи пакета. Неудачная запись пакета
+    повторяется, после WRITE_ATTEMPTS попыток пакет считается потерянным (lost).
+    """
+
+    _STOP = object()
+    WRITE_ATTEMPTS = 3
+
+    def __init__(self, batch_size: int, flush_ms: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+        self.lost = 0
+
+    def record(self, user_id: int, game: str, bet: int, dice_value: int, payout: int):
+        created_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        self._queue.put_nowait((user_id, game, bet, dice_value, payout, created_at))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="bet_ledger")
+
+    async def stop(self):
+        """Дописывает все накопленные записи и останавливает фоновую задачу"""
+        if self._task is None:
+            await self._write(self._drain())
+            return
+        self._queue.put_nowait(self._STOP)
+        await self._task
+        self._task = None
+
+    def _drain(self) -> list[tuple]:
+        batch = []
+        while not self._queue.empty():
+            entry = self._queue.get_nowait()
+            if entry is not self._STOP:
+                batch.append(entry)
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            entry = await self._queue.get()
+            batch = [] if entry is self._STOP else [entry]
+            stopping = entry is self._STOP
+            deadline = loop.time() + self.flush_interval
+            while not stopping and len(batch) < self.batch_size:
+                try:
+                    entry = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        entry = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if entry is self._STOP:
+                    stopping = True
+                else:
+                    batch.append(entry)
+            if stopping:
+                batch.extend(self._drain())
+            await self._write(batch)
+
+    async def _write(self, batch: list[tuple]):
+        if not batch:
+            return
+        for attempt in range(1, self.WRITE_ATTEMPTS + 1):
+            try:
+                async with _writer() as db:
+                    await db.executemany("""
+                        INSERT INTO bets (user_id, game, bet, dice_value, payout, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, batch)
+                    await db.commit()
+                return
+            except Exception as e:
+                if attempt < self.WRITE_ATTEMPTS:
+                    logger.warning(f"Не удалось записать {len(batch)} ставок в журнал (попытка {attempt}): {e}")
+                    await asyncio.sleep(0.5 * attempt)
+                    continue
+                self.lost += len(batch)
+                metrics.registry.inc("bot_bet_ledger_lost_total", len(batch))
+                logger.error(f"Потеряно {len(batch)} ставок журнала (всего {self.lost}): {e}")
+
+bet_ledger = BetLedger(BET_LEDGER_BATCH_SIZE, BET_LEDGER_FLUSH_MS)
+
+def start_bet_ledger():
+    bet_ledger.start()
+
+async def flush_bet_ledger():
+    await bet_ledger.stop()
+
+async def get_user_bets(user_id: int, limit: int = 5) -> list[dict]:
+    """Возвращает последние ставки пользователя"""
+    async with _reader() as db:
+        cursor = await db.execute("""
+            SELECT game, bet, dice_value, payout, created_at
+            FROM bets
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            LIMIT ?
+        """, (user_id, limit))
+        return [dict(row) for row in await cursor.fetchall()]
+
+async def get_game_stats(games: list[str], hours: int = 24) -> dict[str, dict]:
+    """Возвращает по каждой игре число ставок, оборот и выплаты за последние hours часов.
+
+    Читает не больше hours часовых строк game_stats на игру (текущий час — неполный).
+    """
+    result = {}
+    async with _reader() as db:
+        for game in games:
+            cursor = await db.execute("""
+                SELECT COALESCE(SUM(bets), 0) AS bets, COALESCE(SUM(wagered), 0) AS wagered, COALESCE(SUM(paid), 0) AS paid
+                FROM game_stats
+                WHERE game = ? AND hour > strftime('%Y-%m-%d %H:00:00', 'now', ?)
+            """, (game, f"-{hours} hours"))
+            result[game] = dict(await cursor.fetchone())
+    return result
+
+# ==================== СХЕМА И ПОЛЬЗОВАТЕЛИ ====================
 
 async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _writer() as db:
         # Создание основной таблицы users
         await db.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -20,9 +566,11 @@ async def init_db():
                 referrer_id INTEGER DEFAULT NULL,
                 referral_code TEXT UNIQUE,
                 referrals_count INTEGER DEFAULT 0 NOT NULL,
-                referral_earnings INTEGER DEFAULT 0 NOT NULL
+                referral_earnings INTEGER DEFAULT 0 NOT NULL,
+                is_active INTEGER DEFAULT 1 NOT NULL
             )
         ''')
+        await _ensure_column(db, "users", "is_active", "INTEGER DEFAULT 1 NOT NULL")
         
         # Создание таблицы для отслеживания реферальных связей
         await db.execute('''
@@ -38,36 +586,266 @@ async def init_db():
             )
         ''')
         
+        # Индексы реферальной системы: каждого пользователя можно пригласить только один раз,
+        # список рефералов читается по referrer_id в порядке created_at
+        try:
+            await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_referrals_referred ON referrals(referred_id)")
+        except aiosqlite.IntegrityError as e:
+            logger.warning(f"Не удалось создать уникальный индекс referrals(referred_id), есть повторные приглашения: {e}")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id, created_at)")
+        if not await _has_index_on(db, "users", "referral_code"):
+            await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code)")
+        
+        # Индекс для рейтинга по балансу
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance DESC)")
+        
+        # Итоги по казино: одна строка, обновляется триггерами на users в тех же транзакциях
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS casino_totals (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total_users INTEGER DEFAULT 0 NOT NULL,
+                total_balance INTEGER DEFAULT 0 NOT NULL,
+                total_games INTEGER DEFAULT 0 NOT NULL,
+                total_wager INTEGER DEFAULT 0 NOT NULL,
+                casino_profit INTEGER DEFAULT 0 NOT NULL
+            )
+        ''')
+        # Полный просмотр users нужен только при первом запуске, дальше итоги ведут триггеры.
+        # Условие NOT EXISTS в самом запросе просмотр не отменяет: агрегат вычисляется раньше
+        cursor = await db.execute("SELECT 1 FROM casino_totals WHERE id = 1")
+        if await cursor.fetchone() is None:
+            await db.execute(f"INSERT INTO casino_totals SELECT 1, * FROM ({_TOTALS_FROM_USERS})", scan_ok=True)
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_users_totals_insert AFTER INSERT ON users
+            BEGIN
+                UPDATE casino_totals
+                SET total_users = total_users + 1,
+                    total_balance = total_balance + NEW.balance,
+                    total_games = total_games + NEW.games_played,
+                    total_wager = total_wager + NEW.total_wagered,
+                    casino_profit = casino_profit + NEW.net_profit
+                WHERE id = 1;
+            END
+        ''')
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_users_totals_delete AFTER DELETE ON users
+            BEGIN
+                UPDATE casino_totals
+                SET total_users = total_users - 1,
+                    total_balance = total_balance - OLD.balance,
+                    total_games = total_games - OLD.games_played,
+                    total_wager = total_wager - OLD.total_wagered,
+                    casino_profit = casino_profit - OLD.net_profit
+                WHERE id = 1;
+            END
+        ''')
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_users_totals_update
+            AFTER UPDATE OF balance, games_played, total_wagered, net_profit ON users
+            BEGIN
+                UPDATE casino_totals
+                SET total_balance = total_balance + NEW.balance - OLD.balance,
+                    total_games = total_games + NEW.games_played - OLD.games_played,
+                    total_wager = total_wager + NEW.total_wagered - OLD.total_wagered,
+                    casino_profit = casino_profit + NEW.net_profit - OLD.net_profit
+                WHERE id = 1;
+            END
+        ''')
+        
+        # Журнал ставок (пишется пакетами фоновой задачей BetLedger)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS bets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                game TEXT NOT NULL,
+                bet INTEGER NOT NULL,
+                dice_value INTEGER NOT NULL,
+                payout INTEGER NOT NULL,
+                created_at TIMESTAMP NOT NULL
+            )
+        ''')
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_bets_user ON bets(user_id, created_at)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_bets_game ON bets(game, created_at)")
+        
+        # Почасовые итоги по играм для /server_stats: триггер на bets обновляет их в той же транзакции
+        cursor = await db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'game_stats'", scan_ok=True)
+        game_stats_exists = await cursor.fetchone() is not None
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS game_stats (
+                game TEXT NOT NULL,
+                hour TEXT NOT NULL,
+                bets INTEGER DEFAULT 0 NOT NULL,
+                wagered INTEGER DEFAULT 0 NOT NULL,
+                paid INTEGER DEFAULT 0 NOT NULL,
+                PRIMARY KEY (game, hour)
+            ) WITHOUT ROWID
+        ''')
+        if not game_stats_exists:
+            # Однократно переносим последние сутки журнала, накопленные до появления таблицы
+            await db.execute("""
+                INSERT INTO game_stats (game, hour, bets, wagered, paid)
+                SELECT game, strftime('%Y-%m-%d %H:00:00', created_at), COUNT(*), SUM(bet), SUM(payout)
+                FROM bets
+                WHERE created_at >= strftime('%Y-%m-%d %H:00:00', 'now', '-24 hours')
+                GROUP BY 1, 2
+            """, scan_ok=True)
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_bets_game_stats AFTER INSERT ON bets
+            BEGIN
+                INSERT INTO game_stats (game, hour, bets, wagered, paid)
+                VALUES (NEW.game, strftime('%Y-%m-%d %H:00:00', NEW.created_at), 1, NEW.bet, NEW.payout)
+                ON CONFLICT (game, hour) DO UPDATE SET
+                    bets = bets + 1,
+                    wagered = wagered + excluded.wagered,
+                    paid = paid + excluded.paid;
+            END
+        ''')
+        
+        # Выставленные счета на пополнение и зачисленные платежи
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS invoices (
+                payload TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                status TEXT DEFAULT 'pending' NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS payments (
+                telegram_payment_charge_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                status TEXT DEFAULT 'credited' NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Рассылки и их прогресс (last_user_id — последний обработанный пользователь)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message TEXT NOT NULL,
+                chat_id INTEGER,
+                status TEXT DEFAULT 'running' NOT NULL,
+                last_user_id INTEGER DEFAULT 0 NOT NULL,
+                sent INTEGER DEFAULT 0 NOT NULL,
+                failed INTEGER DEFAULT 0 NOT NULL,
+                blocked INTEGER DEFAULT 0 NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+        
         await db.commit()
-        logger.info("База данных и таблицы 'users', 'referrals' успешно проверены/созданы.")
+        logger.info("База данных и таблицы 'users', 'referrals', 'casino_totals', 'bets', 'game_stats', 'invoices', 'payments', 'broadcasts' успешно проверены/созданы.")
+
+async def _has_index_on(db: TracedConnection, table: str, column: str) -> bool:
+    """Проверяет, есть ли индекс, начинающийся с указанной колонки"""
+    cursor = await db.execute(f"PRAGMA index_list({table})")
+    for index in await cursor.fetchall():
+        cursor = await db.execute(f"PRAGMA index_info('{index['name']}')")
+        columns = await cursor.fetchall()
+        if columns and columns[0]['name'] == column:
+            return True
+    return False
+
+async def _ensure_column(db: TracedConnection, table: str, column: str, definition: str):
+    """Добавляет колонку в существующую таблицу, если ее еще нет"""
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    if column not in [col[1] for col in await cursor.fetchall()]:
+        logger.info(f"Добавляем поле {table}.{column}...")
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+async def load_leaderboard():
+    """Заполняет рейтинг в памяти лучшими по балансу пользователями"""
+    async with _reader() as db:
+        # Обход idx_users_balance по убыванию останавливается после LIMIT строк
+        cursor = await db.execute(
+            "SELECT user_id, balance FROM users ORDER BY balance DESC, user_id LIMIT ?", (leaderboard.size,), scan_ok=True,
+        )
+        leaderboard.load(await cursor.fetchall())
+    logger.debug(f"Рейтинг загружен: {len(leaderboard)} пользователей.")
 
 async def add_user_if_not_exists(user_id: int, username: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if not await cursor.fetchone():
-            await db.execute("INSERT INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
-        else:
-            await db.execute("UPDATE users SET username = ? WHERE user_id = ?", (username, user_id))
+    """Создает пользователя или обновляет username и снова делает его активным.
+
+    Строка меняется, только если что-то действительно изменилось, а уже
+    известные пользователи с тем же username вообще не доходят до БД.
+    """
+    if user_id in _known_users and _known_users.get(user_id) == username:
+        return
+    async with _writer() as db:
+        while True:
+            # Реферальный код выдается сразу при регистрации
+            try:
+                cursor = await db.execute('''
+                    INSERT INTO users (user_id, username, referral_code) VALUES (?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, is_active = 1
+                    WHERE username IS NOT excluded.username OR is_active = 0
+                    RETURNING balance
+                ''', (user_id, username, generate_referral_code()))
+                row = await cursor.fetchone()
+                break
+            except aiosqlite.IntegrityError:
+                # Совпал реферальный код, пробуем другой
+                continue
         await db.commit()
+        _known_users.put(user_id, username)
+        # Строка возвращается только при вставке или изменении
+        if row:
+            if leaderboard.loaded:
+                leaderboard.update(user_id, row[0])
+            leaderboard.update_names(user_id, username=username)
 
 async def get_user_balance(user_id: int) -> int:
-    async with aiosqlite.connect(DB_NAME) as db:
+    cached = _balance_cache.get(user_id)
+    if cached is not None:
+        return cached
+    version = _balance_cache.version
+    async with _reader() as db:
         cursor = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
         row = await cursor.fetchone()
-        return row[0] if row else 0
+    if not row:
+        return 0
+    if owns_user(user_id):
+        _balance_cache.fill(user_id, row[0], version)
+    return row[0]
 
-async def update_user_balance(user_id: int, amount: int, relative: bool = False):
-    async with aiosqlite.connect(DB_NAME) as db:
+async def update_user_balance(user_id: int, amount: int, relative: bool = False) -> int | None:
+    async with _writer() as db:
         if relative:
-            await db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+            cursor = await db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ? RETURNING balance", (amount, user_id))
         else:
-            await db.execute("UPDATE users SET balance = ? WHERE user_id = ?", (amount, user_id))
+            cursor = await db.execute("UPDATE users SET balance = ? WHERE user_id = ? RETURNING balance", (amount, user_id))
+        row = await cursor.fetchone()
         await db.commit()
+        _balance_changed(user_id, row)
+        return row[0] if row else None
+
+async def debit_user_balance(user_id: int, amount: int) -> int | None:
+    """Списывает amount, только если на балансе достаточно средств; возвращает новый баланс или None.
+
+    Проверка выполняется в том же UPDATE, поэтому устаревший кэш баланса
+    (например, в другом процессе) не приводит к уходу в минус.
+    """
+    async with _writer() as db:
+        cursor = await db.execute(
+            "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ? RETURNING balance",
+            (amount, user_id, amount),
+        )
+        row = await cursor.fetchone()
+        await db.commit()
+        if not row:
+            return None
+        _balance_changed(user_id, row)
+        return row[0]
 
 async def update_user_stats(user_id: int, bet: int, win_amount: int):
     is_win = 1 if win_amount > 0 else 0
     profit = win_amount - bet
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _writer() as db:
         await db.execute("""
             UPDATE users 
             SET games_played = games_played + 1,
@@ -78,43 +856,184 @@ async def update_user_stats(user_id: int, bet: int, win_amount: int):
         """, (is_win, bet, profit, user_id))
         await db.commit()
 
-async def get_top_users(limit: int = 10) -> list[aiosqlite.Row]:
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("SELECT user_id, username, nickname, balance FROM users ORDER BY balance DESC LIMIT ?", (limit,))
-        return await cursor.fetchall()
+async def settle_bet(user_id: int, game: str, bet: int, dice_value: int, win_amount: int) -> int | None:
+    """Списывает ставку, начисляет выигрыш и обновляет статистику одной транзакцией.
+
+    Возвращает новый баланс или None, если средств на ставку недостаточно.
+    Принятая ставка ставится в очередь журнала bets.
+    """
+    is_win = 1 if win_amount > 0 else 0
+    profit = win_amount - bet
+    async with _writer() as db:
+        cursor = await db.execute("""
+            UPDATE users
+            SET balance = balance - ? + ?,
+                games_played = games_played + 1,
+                games_won = games_won + ?,
+                total_wagered = total_wagered + ?,
+                net_profit = net_profit + ?
+            WHERE user_id = ? AND balance >= ?
+            RETURNING balance
+        """, (bet, win_amount, is_win, bet, profit, user_id, bet))
+        row = await cursor.fetchone()
+        await db.commit()
+        if not row:
+            return None
+        _balance_changed(user_id, row)
+    bet_ledger.record(user_id, game, bet, dice_value, win_amount)
+    return row[0]
+
+async def get_top_users(limit: int = 10) -> list[dict]:
+    if not leaderboard.loaded or limit > leaderboard.size:
+        async with _reader() as db:
+            cursor = await db.execute(
+                "SELECT user_id, username, nickname, balance FROM users ORDER BY balance DESC, user_id LIMIT ?", (limit,), scan_ok=True,
+            )
+            return [dict(row) for row in await cursor.fetchall()]
+
+    if not leaderboard.covers(limit):
+        # Игроки топа проиграли и выпали из него: перечитываем, кто теперь на их местах
+        await load_leaderboard()
+    top = leaderboard.top(limit)
+    missing = leaderboard.missing_names(user_id for user_id, _ in top)
+    if missing:
+        # Имена подгружаются только для новых участников топа
+        placeholders = ", ".join("?" * len(missing))
+        async with _reader() as db:
+            cursor = await db.execute(f"SELECT user_id, username, nickname FROM users WHERE user_id IN ({placeholders})", missing)
+            for row in await cursor.fetchall():
+                leaderboard.set_names(row['user_id'], row['username'], row['nickname'])
+
+    result = []
+    for user_id, balance in top:
+        username, nickname = leaderboard.names(user_id)
+        result.append({"user_id": user_id, "username": username, "nickname": nickname, "balance": balance})
+    return result
+
+async def get_user_rank(user_id: int) -> int | None:
+    """Возвращает место пользователя в рейтинге по балансу.
+
+    Вне топа в памяти место считается по idx_users_balance: COUNT читает
+    только записи индекса с балансом выше, чем у пользователя.
+    """
+    rank = leaderboard.rank(user_id)
+    if rank is not None:
+        return rank
+    async with _reader() as db:
+        cursor = await db.execute("""
+            SELECT (SELECT COUNT(*) FROM users WHERE balance > u.balance) + 1
+            FROM users u
+            WHERE u.user_id = ?
+        """, (user_id,))
+        row = await cursor.fetchone()
+        return row[0] if row else None
 
 async def set_user_nickname(user_id: int, nickname: str):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _writer() as db:
         await db.execute("UPDATE users SET nickname = ? WHERE user_id = ?", (nickname, user_id))
         await db.commit()
+        leaderboard.update_names(user_id, nickname=nickname)
+
+# Допустимые фильтры для iter_user_ids
+USER_FILTERS = {
+    "active": "is_active = 1",
+    "has_balance": "balance > 0",
+}
+
+async def iter_user_id_batches(batch_size: int = 1000, where: str | tuple[str, ...] | None = None, start_after: int = 0):
+    """Выдает ID пользователей страницами по возрастанию (keyset-пагинация по user_id).
+
+    where — имя фильтра из USER_FILTERS или кортеж имен. Соединение берется
+    заново на каждую страницу, поэтому медленный потребитель не держит пул.
+    """
+    filters = (where,) if isinstance(where, str) else tuple(where or ())
+    query = "SELECT user_id FROM users WHERE user_id > ?"
+    for name in filters:
+        query += f" AND {USER_FILTERS[name]}"
+    query += " ORDER BY user_id LIMIT ?"
+
+    last_user_id = start_after
+    while True:
+        async with _reader() as db:
+            cursor = await db.execute(query, (last_user_id, batch_size))
+            user_ids = [row[0] for row in await cursor.fetchall()]
+        if not user_ids:
+            return
+        yield user_ids
+        if len(user_ids) < batch_size:
+            return
+        last_user_id = user_ids[-1]
+
+async def iter_user_ids(batch_size: int = 1000, where: str | tuple[str, ...] | None = None, start_after: int = 0):
+    """Выдает ID пользователей по одному, загружая их страницами"""
+    async for user_ids in iter_user_id_batches(batch_size, where, start_after):
+        for user_id in user_ids:
+            yield user_id
+
+async def deactivate_users(user_ids: list[int]):
+    """Помечает пользователей, заблокировавших бота, неактивными"""
+    if not user_ids:
+        return
+    async with _writer() as db:
+        await db.executemany("UPDATE users SET is_active = 0 WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+        await db.commit()
+        # Вернувшийся пользователь должен снова стать активным при следующем /start
+        for user_id in user_ids:
+            if owns_user(user_id):
+                _known_users.pop(user_id)
+            else:
+                _notify_owner(user_id)
 
-async def get_all_user_ids() -> list[int]:
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("SELECT user_id FROM users")
-        rows = await cursor.fetchall()
-        return [row[0] for row in rows]
+# Полный пересчет итогов по таблице users (используется при сверке и первичном заполнении)
+_TOTALS_FROM_USERS = """
+    SELECT
+        COUNT(user_id) as total_users,
+        COALESCE(SUM(balance), 0) as total_balance,
+        COALESCE(SUM(games_played), 0) as total_games,
+        COALESCE(SUM(total_wagered), 0) as total_wager,
+        COALESCE(SUM(net_profit), 0) as casino_profit
+    FROM users
+"""
 
 async def get_global_stats() -> dict | None:
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    """Возвращает итоги из casino_totals, которые триггеры поддерживают в актуальном состоянии"""
+    async with _reader() as db:
         cursor = await db.execute("""
-            SELECT 
-                COUNT(user_id) as total_users,
-                SUM(balance) as total_balance,
-                SUM(games_played) as total_games,
-                SUM(total_wagered) as total_wager,
-                SUM(net_profit) as casino_profit
-            FROM users
+            SELECT total_users, total_balance, total_games, total_wager, casino_profit
+            FROM casino_totals
+            WHERE id = 1
         """)
         row = await cursor.fetchone()
         return dict(row) if row else None
 
+async def reconcile_totals() -> dict:
+    """Пересчитывает casino_totals с нуля и возвращает расхождения {поле: (было, стало)}"""
+    async with _writer() as db:
+        # Чтение и перезапись в одной транзакции: процессы-обработчики не изменят users между ними
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute(_TOTALS_FROM_USERS, scan_ok=True)
+        actual = dict(await cursor.fetchone())
+        cursor = await db.execute("SELECT total_users, total_balance, total_games, total_wager, casino_profit FROM casino_totals WHERE id = 1")
+        row = await cursor.fetchone()
+        stored = dict(row) if row else {}
+        await db.execute("""
+            INSERT OR REPLACE INTO casino_totals (id, total_users, total_balance, total_games, total_wager, casino_profit)
+            VALUES (1, :total_users, :total_balance, :total_games, :total_wager, :casino_profit)
+        """, actual)
+        await db.commit()
+    drift = {key: (stored.get(key), value) for key, value in actual.items() if stored.get(key) != value}
+    if drift:
+        logger.warning(f"Расхождение casino_totals исправлено: {drift}")
+    return drift
+
 # ==================== РЕФЕРАЛЬНАЯ СИСТЕМА ====================
 
 import secrets
 import string
 
+REFERRAL_BONUS_REFERRED = 50
+REFERRAL_BONUS_REFERRER = 25
+
 def generate_referral_code() -> str:
     """Генерирует уникальный реферальный код"""
     alphabet = string.ascii_uppercase + string.digits
@@ -122,91 +1041,81 @@ def generate_referral_code() -> str:
 
 async def get_user_by_referral_code(referral_code: str) -> int | None:
     """Находит пользователя по реферальному коду"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _reader() as db:
         cursor = await db.execute("SELECT user_id FROM users WHERE referral_code = ?", (referral_code,))
         row = await cursor.fetchone()
         return row[0] if row else None
 
-async def add_referral_relationship(referrer_id: int, referred_id: int) -> bool:
-    """Создает реферальную связь между пользователями"""
-    try:
-        async with aiosqlite.connect(DB_NAME) as db:
-            await db.execute("""
-                INSERT INTO referrals (referrer_id, referred_id) 
-                VALUES (?, ?)
-            """, (referrer_id, referred_id))
-            await db.commit()
-            return True
-    except aiosqlite.IntegrityError:
-        # Связь уже существует
-        return False
+async def get_user_referrals(user_id: int, limit: int = 10, cursor: int | None = None, backward: bool = False) -> list[aiosqlite.Row]:
+    """Получает страницу рефералов пользователя, от новых к старым.
 
-async def get_user_referrals(user_id: int) -> list[aiosqlite.Row]:
-    """Получает список рефералов пользователя"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute("""
-            SELECT r.referred_id, u.username, u.nickname, r.created_at
-            FROM referrals r
-            JOIN users u ON r.referred_id = u.user_id
-            WHERE r.referrer_id = ?
-            ORDER BY r.created_at DESC
-        """, (user_id,))
-        return await cursor.fetchall()
+    cursor — id записи в referrals, от которой отсчитывается страница
+    (keyset по created_at, id): без backward возвращаются более старые записи,
+    с backward — более новые. Порядок результата всегда от новых к старым.
+    """
+    query = """
+        SELECT r.id, r.referred_id, u.username, u.nickname, r.created_at
+        FROM referrals r
+        JOIN users u ON r.referred_id = u.user_id
+        WHERE r.referrer_id = ?
+    """
+    params = [user_id]
+    if cursor is not None:
+        query += f" AND (r.created_at, r.id) {'>' if backward else '<'} (SELECT created_at, id FROM referrals WHERE id = ?)"
+        params.append(cursor)
+    query += " ORDER BY r.created_at ASC, r.id ASC" if backward else " ORDER BY r.created_at DESC, r.id DESC"
+    query += " LIMIT ?"
+    params.append(limit)
+    async with _reader() as db:
+        db_cursor = await db.execute(query, params)
+        rows = await db_cursor.fetchall()
+    return rows[::-1] if backward else rows
 
-async def update_referral_stats(user_id: int):
-    """Обновляет статистику рефералов пользователя"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Подсчитываем количество рефералов
+async def register_referral(referrer_id: int, referred_id: int) -> bool:
+    """Регистрирует реферала и начисляет бонусы одной транзакцией.
+
+    Повторная регистрация отсекается уникальным индексом по referred_id,
+    счетчик рефералов увеличивается на единицу без пересчета.
+    """
+    async with _writer() as db:
         cursor = await db.execute("""
-            SELECT COUNT(*) FROM referrals WHERE referrer_id = ?
-        """, (user_id,))
-        referrals_count = (await cursor.fetchone())[0]
+            INSERT OR IGNORE INTO referrals (referrer_id, referred_id, bonus_paid)
+            VALUES (?, ?, TRUE)
+        """, (referrer_id, referred_id))
+        if cursor.rowcount == 0:
+            # Пользователь уже был приглашен
+            await db.rollback()
+            return False
         
-        # Обновляем статистику
-        await db.execute("""
+        # Начисляем 50 звезд новому пользователю
+        cursor = await db.execute("""
             UPDATE users 
-            SET referrals_count = ?
+            SET balance = balance + ?,
+                referrer_id = ?
             WHERE user_id = ?
-        """, (referrals_count, user_id))
+            RETURNING balance
+        """, (REFERRAL_BONUS_REFERRED, referrer_id, referred_id))
+        referred_row = await cursor.fetchone()
+        
+        # Начисляем 25 звезд рефереру
+        cursor = await db.execute("""
+            UPDATE users 
+            SET balance = balance + ?,
+                referral_earnings = referral_earnings + ?,
+                referrals_count = referrals_count + 1
+            WHERE user_id = ?
+            RETURNING balance
+        """, (REFERRAL_BONUS_REFERRER, REFERRAL_BONUS_REFERRER, referrer_id))
+        referrer_row = await cursor.fetchone()
+        
         await db.commit()
-
-async def pay_referral_bonuses(referrer_id: int, referred_id: int) -> bool:
-    """Начисляет бонусы за реферала"""
-    try:
-        async with aiosqlite.connect(DB_NAME) as db:
-            # Начисляем 50 звезд новому пользователю
-            await db.execute("""
-                UPDATE users 
-                SET balance = balance + 50 
-                WHERE user_id = ?
-            """, (referred_id,))
-            
-            # Начисляем 25 звезд рефереру
-            await db.execute("""
-                UPDATE users 
-                SET balance = balance + 25,
-                    referral_earnings = referral_earnings + 25
-                WHERE user_id = ?
-            """, (referrer_id,))
-            
-            # Отмечаем, что бонусы выплачены
-            await db.execute("""
-                UPDATE referrals 
-                SET bonus_paid = TRUE 
-                WHERE referrer_id = ? AND referred_id = ?
-            """, (referrer_id, referred_id))
-            
-            await db.commit()
-            return True
-    except Exception as e:
-        logger.error(f"Ошибка при начислении реферальных бонусов: {e}")
-        return False
+        _balance_changed(referred_id, referred_row)
+        _balance_changed(referrer_id, referrer_row)
+        return True
 
 async def get_user_referral_info(user_id: int) -> dict | None:
     """Получает информацию о рефералах пользователя"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+    async with _reader() as db:
         cursor = await db.execute("""
             SELECT referral_code, referrals_count, referral_earnings
             FROM users 
@@ -216,21 +1125,175 @@ async def get_user_referral_info(user_id: int) -> dict | None:
         return dict(row) if row else None
 
 async def ensure_referral_code(user_id: int) -> str:
-    """Убеждается, что у пользователя есть реферальный код, создает если нет"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    """Возвращает реферальный код пользователя, создает если нет"""
+    code = _referral_codes.get(user_id)
+    if code:
+        return code
+    async with _reader() as db:
         cursor = await db.execute("SELECT referral_code FROM users WHERE user_id = ?", (user_id,))
         row = await cursor.fetchone()
-        
-        if row and row[0]:
-            return row[0]
-        
-        # Генерируем новый код
+    if row and row[0]:
+        _referral_codes.put(user_id, row[0])
+        return row[0]
+    
+    async with _writer() as db:
         while True:
-            new_code = generate_referral_code()
             try:
-                await db.execute("UPDATE users SET referral_code = ? WHERE user_id = ?", (new_code, user_id))
+                # COALESCE: код мог появиться, пока мы ждали писателя (например, из фонового заполнения)
+                cursor = await db.execute(
+                    "UPDATE users SET referral_code = COALESCE(referral_code, ?) WHERE user_id = ? RETURNING referral_code",
+                    (generate_referral_code(), user_id),
+                )
+                row = await cursor.fetchone()
                 await db.commit()
-                return new_code
+                break
             except aiosqlite.IntegrityError:
                 # Код уже существует, пробуем другой
-                continue
\ No newline at end of file
+                continue
+    if not row:
+        raise ValueError(f"Пользователь {user_id} не найден")
+    _referral_codes.put(user_id, row[0])
+    return row[0]
+
+async def backfill_referral_codes(batch_size: int = 500) -> int:
+    """Выдает реферальные коды пользователям, зарегистрированным до их появления.
+
+    Работает пачками, чтобы не держать писателя надолго; возвращает число обновленных пользователей.
+    """
+    total = 0
+    while True:
+        async with _reader() as db:
+            cursor = await db.execute("SELECT user_id FROM users WHERE referral_code IS NULL LIMIT ?", (batch_size,))
+            user_ids = [row[0] for row in await cursor.fetchall()]
+        if not user_ids:
+            return total
+        async with _writer() as db:
+            try:
+                await db.executemany(
+                    "UPDATE users SET referral_code = ? WHERE user_id = ? AND referral_code IS NULL",
+                    [(generate_referral_code(), user_id) for user_id in user_ids],
+                )
+                await db.commit()
+            except aiosqlite.IntegrityError:
+                # Совпал код: откатываем пачку и повторяем с новыми кодами
+                await db.rollback()
+                continue
+        total += len(user_ids)
+
+# ==================== ПЛАТЕЖИ ====================
+
+async def create_invoice(payload: str, user_id: int, amount: int):
+    """Запоминает выставленный счет, чтобы проверить его в pre-checkout"""
+    async with _writer() as db:
+        await db.execute("INSERT INTO invoices (payload, user_id, amount) VALUES (?, ?, ?)", (payload, user_id, amount))
+        await db.commit()
+
+async def is_pending_invoice(payload: str, user_id: int, amount: int) -> bool:
+    """Проверяет, что счет выставлен этому пользователю на эту сумму и еще не оплачен"""
+    async with _reader() as db:
+        cursor = await db.execute(
+            "SELECT 1 FROM invoices WHERE payload = ? AND user_id = ? AND amount = ? AND status = 'pending'",
+            (payload, user_id, amount),
+        )
+        return await cursor.fetchone() is not None
+
+class PaymentRejectedError(Exception):
+    """Платеж не совпал с ожидающим счетом и не зачислен: деньги нужно вернуть"""
+
+def _check_repeated_payment(charge_id: str, status: str) -> None:
+    """Повтор зачисленного (или уже возвращенного) платежа пропускается, отклоненного — снова отклоняется"""
+    if status == 'rejected':
+        raise PaymentRejectedError(f"Платеж {charge_id} не совпал с ожидающим счетом")
+
+async def credit_payment(charge_id: str, payload: str, user_id: int, amount: int) -> int | None:
+    """Зачисляет платеж и возвращает новый баланс; повторная доставка зачисленного платежа возвращает None.
+
+    Запись в payments, закрытие счета и пополнение баланса выполняются одной транзакцией,
+    уникальный telegram_payment_charge_id не дает зачислить платеж дважды. Платеж без
+    ожидающего счета с тем же пользователем и суммой (например, второй из двух одновременных
+    pre-checkout) записывается со статусом 'rejected', а вызывающему бросается PaymentRejectedError.
+    """
+    # Повторы при перепосылке обновлений отсекаются чтением, без захвата писателя
+    async with _reader() as db:
+        cursor = await db.execute("SELECT status FROM payments WHERE telegram_payment_charge_id = ?", (charge_id,))
+        row = await cursor.fetchone()
+    if row:
+        _check_repeated_payment(charge_id, row[0])
+        return None
+    
+    async with _writer() as db:
+        cursor = await db.execute("""
+            INSERT INTO payments (telegram_payment_charge_id, payload, user_id, amount)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (telegram_payment_charge_id) DO NOTHING
+        """, (charge_id, payload, user_id, amount))
+        if cursor.rowcount == 0:
+            await db.rollback()
+            cursor = await db.execute("SELECT status FROM payments WHERE telegram_payment_charge_id = ?", (charge_id,))
+            _check_repeated_payment(charge_id, (await cursor.fetchone())[0])
+            return None
+        cursor = await db.execute("""
+            UPDATE invoices SET status = 'paid'
+            WHERE payload = ? AND user_id = ? AND amount = ? AND status = 'pending'
+        """, (payload, user_id, amount))
+        row = None
+        if cursor.rowcount:
+            cursor = await db.execute(
+                "UPDATE users SET balance = balance + ? WHERE user_id = ? RETURNING balance", (amount, user_id)
+            )
+            row = await cursor.fetchone()
+        if row is None:
+            await db.rollback()
+            await db.execute("""
+                INSERT INTO payments (telegram_payment_charge_id, payload, user_id, amount, status)
+                VALUES (?, ?, ?, ?, 'rejected')
+            """, (charge_id, payload, user_id, amount))
+            await db.commit()
+            raise PaymentRejectedError(f"Платеж {charge_id} пользователя {user_id} на {amount} не совпал с ожидающим счетом {payload}")
+        await db.commit()
+        _balance_changed(user_id, row)
+        return row[0]
+
+async def mark_payment_refunded(charge_id: str):
+    """Отмечает отклоненный платеж возвращенным, чтобы повторная доставка его пропускала"""
+    async with _writer() as db:
+        await db.execute(
+            "UPDATE payments SET status = 'refunded' WHERE telegram_payment_charge_id = ? AND status = 'rejected'", (charge_id,)
+        )
+        await db.commit()
+
+# ==================== РАССЫЛКИ ====================
+
+async def create_broadcast(message: str, chat_id: int) -> dict:
+    """Создает запись о рассылке"""
+    async with _writer() as db:
+        cursor = await db.execute("INSERT INTO broadcasts (message, chat_id) VALUES (?, ?) RETURNING *", (message, chat_id))
+        row = await cursor.fetchone()
+        await db.commit()
+        return dict(row)
+
+async def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked: int):
+    async with _writer() as db:
+        await db.execute("""
+            UPDATE broadcasts
+            SET last_user_id = ?, sent = ?, failed = ?, blocked = ?
+            WHERE id = ?
+        """, (last_user_id, sent, failed, blocked, broadcast_id))
+        await db.commit()
+
+async def finish_broadcast(broadcast_id: int, status: str = 'done') -> dict | None:
+    """Закрывает рассылку со статусом done или failed и возвращает ее итоговую запись"""
+    async with _writer() as db:
+        cursor = await db.execute(
+            "UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ? RETURNING *", (status, broadcast_id)
+        )
+        row = await cursor.fetchone()
+        await db.commit()
+        return dict(row) if row else None
+
+async def get_unfinished_broadcasts() -> list[dict]:
+    """Возвращает рассылки, прерванные до завершения"""
+    async with _reader() as db:
+        # Рассылок единицы, а вызывается один раз при запуске: индекс по status не нужен
+        cursor = await db.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id", scan_ok=True)
+        return [dict(row) for row in await cursor.fetchall()]
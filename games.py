@@ -0,0 +1,42 @@
+from typing import NamedTuple
+
+class Outcome(NamedTuple):
+    multiplier: float
+    text: str
+
+class Game(NamedTuple):
+    key: str
+    emoji: str
+    name: str
+    # Исход по значению кубика: outcomes[dice_value], индекс 0 не используется
+    outcomes: tuple[Outcome, ...]
+    # Теоретический возврат игроку (доля от ставки) при равновероятных значениях
+    rtp: float
+
+LOSS = Outcome(0, "К сожалению, вы проиграли.")
+
+def _build_game(key: str, emoji: str, name: str, faces: int, wins: dict[int, Outcome]) -> Game:
+    outcomes = (LOSS,) + tuple(wins.get(value, LOSS) for value in range(1, faces + 1))
+    rtp = sum(outcome.multiplier for outcome in outcomes[1:]) / faces
+    return Game(key, emoji, name, outcomes, rtp)
+
+_BALL_WINS = {
+    5: Outcome(2.5, "ГОЛ! Вы победили!"),
+    4: Outcome(1, "Почти! Ваша ставка возвращена."),
+}
+
+GAMES: dict[str, Game] = {game.key: game for game in (
+    _build_game("dice", "🎲", "кости", 6, {
+        6: Outcome(3, "Выпало 6! Ваш выигрыш!"),
+        5: Outcome(2, "Выпало 5! Вы победили!"),
+    }),
+    _build_game("basketball", "🏀", "баскетбол", 5, _BALL_WINS),
+    _build_game("football", "⚽", "футбол", 5, _BALL_WINS),
+    # Исторически слот-машина хранится под ключом "dart" (callback_data "game_dart")
+    _build_game("dart", "🎰", "слот-машина", 64, {
+        64: Outcome(50, "ДЖЕКПОТ! 7️⃣7️⃣7️⃣"),
+        43: Outcome(10, "Неплохо! Три лимона! 🍋🍋🍋"),
+        22: Outcome(20, "Отлично! Три винограда! 🍇🍇🍇"),
+        1: Outcome(5, "Выигрыш! Три BAR! 🅱️🅱️🅱️"),
+    }),
+)}
@@ -5,13 +5,21 @@ from html import escape
 from telegram import Update
 from telegram.ext import ContextTypes, ConversationHandler
 import database
+from games import GAMES
 from config import MIN_BET, MAX_BET, MIN_WITHDRAWAL, ADMIN_CHAT_ID
-from ui import get_main_menu_keyboard, get_game_choice_keyboard, get_back_to_menu_keyboard_nested, get_back_to_menu_keyboard_simple, get_post_game_keyboard
+from ui import (
+    get_main_menu_keyboard, get_game_choice_keyboard, get_back_to_menu_keyboard_nested, get_back_to_menu_keyboard_simple,
+    get_post_game_keyboard, get_referral_menu_keyboard, get_referral_stats_keyboard, get_referral_list_keyboard,
+)
 
 logger = logging.getLogger(__name__)
 
 MAIN_MENU, GAME_CHOICE, BET_PLACEMENT, RESULT_SHOWN, POST_GAME_CHOICE, CHANGE_BET, WITHDRAW_AMOUNT, REQUEST_SENT, SETTING_NICKNAME, NICKNAME_SET, REFERRAL_MENU = range(11)
 
+# Сколько длится анимация кубика в Telegram до показа результата
+DICE_ANIMATION_SECONDS = 3.5
+REFERRALS_PAGE_SIZE = 20
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     await database.add_user_if_not_exists(user.id, user.username)
@@ -24,8 +32,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         ref_match = re.search(r'/start\s+(\w+)', update.message.text)
         if ref_match:
             referral_code = ref_match.group(1)
-            await process_referral_registration(user.id, referral_code, context)
-            referral_bonus_text = "\n\n🎁 <b>Бонус за регистрацию по реферальной ссылке: +50 ⭐</b>"
+            if await process_referral_registration(user.id, referral_code, context):
+                referral_bonus_text = "\n\n🎁 <b>Бонус за регистрацию по реферальной ссылке: +50 ⭐</b>"
     
     logger.info(f"Пользователь {user.id} ({user.username}) запустил/перезапустил бота.")
     
@@ -113,47 +121,16 @@ async def place_bet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await update.message.reply_text(f"Некорректная ставка. Ваш баланс: {user_balance} ⭐.", reply_markup=get_back_to_menu_keyboard_nested())
         return RESULT_SHOWN
 
-    await database.update_user_balance(user.id, -bet, relative=True)
-    
-    game_emoji = {"dice": "🎲", "basketball": "🏀", "football": "⚽", "dart": "🎰"}[context.user_data["game"]]
-    
-    msg = await context.bot.send_dice(chat_id=update.effective_chat.id, emoji=game_emoji)
-    
-    await asyncio.sleep(3.5)
-    
-    dice_value = msg.dice.value
-    win_amount = 0
-    result_text = "К сожалению, вы проиграли."
     game = context.user_data["game"]
-
-    if game == 'dart':
-        if dice_value == 64: win_amount, result_text = bet * 50, "ДЖЕКПОТ! 7️⃣7️⃣7️⃣"
-        elif dice_value == 43: win_amount, result_text = bet * 10, "Неплохо! Три лимона! 🍋🍋🍋"
-        elif dice_value == 22: win_amount, result_text = bet * 20, "Отлично! Три винограда! 🍇🍇🍇"
-        elif dice_value == 1: win_amount, result_text = bet * 5, "Выигрыш! Три BAR! 🅱️🅱️🅱️"
-    elif game == 'dice':
-        if dice_value == 6: win_amount, result_text = bet * 3, "Выпало 6! Ваш выигрыш!"
-        elif dice_value == 5: win_amount, result_text = bet * 2, "Выпало 5! Вы победили!"
-    elif game in ['basketball', 'football']:
-        if dice_value == 5: win_amount, result_text = int(bet * 2.5), "ГОЛ! Вы победили!"
-        elif dice_value == 4: win_amount, result_text = bet, "Почти! Ваша ставка возвращена."
-
-    if win_amount > 0:
-        await database.update_user_balance(user.id, win_amount, relative=True)
     
-    await database.update_user_stats(user.id, bet, win_amount)
-    
-    final_balance = await database.get_user_balance(user.id)
+    if not await play_round(update, context, game, bet):
+        user_balance = await database.get_user_balance(user.id)
+        await update.message.reply_text(f"Недостаточно средств для ставки. Ваш баланс: {user_balance} ⭐.", reply_markup=get_back_to_menu_keyboard_nested())
+        return RESULT_SHOWN
     
     # Сохраняем данные игры для повторного использования
     context.user_data["current_game"] = game
     context.user_data["current_bet"] = bet
-    
-    text = (f"{result_text}\n\n"
-            f"Ваша ставка: {bet} ⭐ | Выигрыш: {win_amount} ⭐\n"
-            f"Ваш новый баланс: <b>{final_balance}</b> ⭐")
-    
-    await update.message.reply_html(text, reply_markup=get_post_game_keyboard())
     return POST_GAME_CHOICE
 
 async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -183,8 +160,12 @@ async def process_withdrawal_amount(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text(f"Некорректная сумма. Ваш баланс: {user_balance} ⭐.", reply_markup=get_back_to_menu_keyboard_nested())
         return REQUEST_SENT
 
-    await database.update_user_balance(user.id, -amount, relative=True)
-    new_balance = await database.get_user_balance(user.id)
+    # Кэш мог устареть: списание проверяет баланс еще раз в самом UPDATE
+    new_balance = await database.debit_user_balance(user.id, amount)
+    if new_balance is None:
+        user_balance = await database.get_user_balance(user.id)
+        await update.message.reply_text(f"Недостаточно средств. Ваш баланс: {user_balance} ⭐.", reply_markup=get_back_to_menu_keyboard_nested())
+        return REQUEST_SENT
 
     admin_message = (f"❗️ <b>Новый запрос на вывод</b> ❗️\n\n"
                      f"Пользователь: {user.mention_html()} ({user.id})\n"
@@ -226,6 +207,11 @@ async def show_top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             if user['user_id'] == update.effective_user.id:
                 line = f"➡️ {line}"
             text += line
+        
+        if all(user['user_id'] != update.effective_user.id for user in top_users):
+            user_rank = await database.get_user_rank(update.effective_user.id)
+            if user_rank:
+                text += f"\nВаше место: <b>{user_rank}</b>"
             
     reply_markup = get_back_to_menu_keyboard_simple()
     
@@ -289,8 +275,7 @@ async def handle_post_game_change_bet(update: Update, context: ContextTypes.DEFA
         await query.edit_message_text("Ошибка: игра не найдена.", reply_markup=get_back_to_menu_keyboard_nested())
         return ConversationHandler.END
     
-    game_names = {"dice": "кости", "basketball": "баскетбол", "football": "футбол", "dart": "слот-машина"}
-    game_name = game_names.get(current_game, current_game)
+    game_name = GAMES[current_game].name if current_game in GAMES else current_game
     
     await query.edit_message_text(
         f"Вы играете в {game_name}. Введите новую ставку (от {MIN_BET} до {MAX_BET} ⭐):",
@@ -361,57 +346,59 @@ async def play_game_with_bet(update: Update, context: ContextTypes.DEFAULT_TYPE,
             await query.edit_message_text("Ошибка: игра не найдена.", reply_markup=get_back_to_menu_keyboard_nested())
         return ConversationHandler.END
     
-    await database.update_user_balance(user.id, -bet, relative=True)
-    
-    game_emoji = {"dice": "🎲", "basketball": "🏀", "football": "⚽", "dart": "🎰"}[game]
-    
-    msg = await context.bot.send_dice(chat_id=update.effective_chat.id, emoji=game_emoji)
-    
-    await asyncio.sleep(3.5)
+    if not await play_round(update, context, game, bet):
+        user_balance = await database.get_user_balance(user.id)
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"Недостаточно средств для ставки. Ваш баланс: {user_balance} ⭐",
+            reply_markup=get_back_to_menu_keyboard_nested()
+        )
+        return ConversationHandler.END
     
-    dice_value = msg.dice.value
-    win_amount = 0
-    result_text = "К сожалению, вы проиграли."
+    # Обновляем сохраненную ставку
+    context.user_data["current_bet"] = bet
+    return POST_GAME_CHOICE
 
-    if game == 'dart':
-        if dice_value == 64: win_amount, result_text = bet * 50, "ДЖЕКПОТ! 7️⃣7️⃣7️⃣"
-        elif dice_value == 43: win_amount, result_text = bet * 10, "Неплохо! Три лимона! 🍋🍋🍋"
-        elif dice_value == 22: win_amount, result_text = bet * 20, "Отлично! Три винограда! 🍇🍇🍇"
-        elif dice_value == 1: win_amount, result_text = bet * 5, "Выигрыш! Три BAR! 🅱️🅱️🅱️"
-    elif game == 'dice':
-        if dice_value == 6: win_amount, result_text = bet * 3, "Выпало 6! Ваш выигрыш!"
-        elif dice_value == 5: win_amount, result_text = bet * 2, "Выпало 5! Вы победили!"
-    elif game in ['basketball', 'football']:
-        if dice_value == 5: win_amount, result_text = int(bet * 2.5), "ГОЛ! Вы победили!"
-        elif dice_value == 4: win_amount, result_text = bet, "Почти! Ваша ставка возвращена."
+async def play_round(update: Update, context: ContextTypes.DEFAULT_TYPE, game: str, bet: int) -> bool:
+    """Бросает кубик, рассчитывает ставку и планирует показ результата.
 
-    if win_amount > 0:
-        await database.update_user_balance(user.id, win_amount, relative=True)
+    Возвращает False, если к моменту расчета на балансе не хватило средств.
+    """
+    msg = await context.bot.send_dice(chat_id=update.effective_chat.id, emoji=GAMES[game].emoji)
     
-    await database.update_user_stats(user.id, bet, win_amount)
-    
-    final_balance = await database.get_user_balance(user.id)
-    
-    # Обновляем сохраненную ставку
-    context.user_data["current_bet"] = bet
+    outcome = GAMES[game].outcomes[msg.dice.value]
+    win_amount = int(bet * outcome.multiplier)
+
+    final_balance = await database.settle_bet(update.effective_user.id, game, bet, msg.dice.value, win_amount)
+    if final_balance is None:
+        return False
     
-    text = (f"{result_text}\n\n"
+    text = (f"{outcome.text}\n\n"
             f"Ваша ставка: {bet} ⭐ | Выигрыш: {win_amount} ⭐\n"
             f"Ваш новый баланс: <b>{final_balance}</b> ⭐")
     
-    # Отправляем результат в зависимости от типа обновления
-    if update.message:
-        await update.message.reply_html(text, reply_markup=get_post_game_keyboard())
-    else:
-        # Если это callback_query, отправляем новое сообщение
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=text,
-            reply_markup=get_post_game_keyboard(),
-            parse_mode='HTML'
-        )
-    
-    return POST_GAME_CHOICE
+    schedule_game_result(update, context, text)
+    return True
+
+def schedule_game_result(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
+    """Показывает результат после окончания анимации, не задерживая обработку обновлений.
+
+    Ставка к этому моменту уже рассчитана в БД, откладывается только сообщение.
+    """
+    context.application.create_task(
+        send_game_result(context, update.effective_chat.id, text),
+        update=update,
+        name=f"game_result_{update.effective_chat.id}"
+    )
+
+async def send_game_result(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str) -> None:
+    await asyncio.sleep(DICE_ANIMATION_SECONDS)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        reply_markup=get_post_game_keyboard(),
+        parse_mode='HTML'
+    )
 
 # ==================== РЕФЕРАЛЬНАЯ СИСТЕМА ====================
 
@@ -429,28 +416,11 @@ async def process_referral_registration(user_id: int, referral_code: str, contex
             logger.warning(f"Пользователь {user_id} пытается зарегистрироваться по своей ссылке")
             return False
         
-        # Проверяем, что пользователь еще не был приглашен
-        cursor = await database.get_user_referrals(referrer_id)
-        for referral in cursor:
-            if referral['referred_id'] == user_id:
-                logger.warning(f"Пользователь {user_id} уже был приглашен пользователем {referrer_id}")
-                return False
-        
-        # Создаем реферальную связь
-        success = await database.add_referral_relationship(referrer_id, user_id)
-        if not success:
-            logger.error(f"Не удалось создать реферальную связь: {referrer_id} -> {user_id}")
+        # Создаем связь и начисляем бонусы; повторное приглашение отсекается в БД
+        if not await database.register_referral(referrer_id, user_id):
+            logger.warning(f"Пользователь {user_id} уже был приглашен ранее")
             return False
         
-        # Начисляем бонусы
-        bonus_success = await database.pay_referral_bonuses(referrer_id, user_id)
-        if not bonus_success:
-            logger.error(f"Не удалось начислить реферальные бонусы: {referrer_id} -> {user_id}")
-            return False
-        
-        # Обновляем статистику
-        await database.update_referral_stats(referrer_id)
-        
         logger.info(f"Успешная реферальная регистрация: {referrer_id} -> {user_id}")
         return True
         
@@ -470,7 +440,6 @@ async def referral_system(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     text += "• Вы получаете <b>25 ⭐</b> за каждого приглашённого\n\n"
     text += "Выберите действие:"
     
-    from ui import get_referral_menu_keyboard
     reply_markup = get_referral_menu_keyboard()
     
     # Удаляем старое сообщение и отправляем новое
@@ -508,15 +477,14 @@ async def show_referral_stats(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     if referral_info['referrals_count'] > 0:
         text += "📋 <b>Ваши рефералы:</b>\n"
-        referrals = await database.get_user_referrals(user_id)
-        for i, referral in enumerate(referrals[:5], 1):  # Показываем только первые 5
+        referrals = await database.get_user_referrals(user_id, limit=5)  # Показываем только последние 5
+        for i, referral in enumerate(referrals, 1):
             name = referral['nickname'] or referral['username'] or f"Пользователь {referral['referred_id']}"
             text += f"{i}. {name}\n"
         
-        if len(referrals) > 5:
-            text += f"... и ещё {len(referrals) - 5} пользователей\n"
+        if referral_info['referrals_count'] > 5:
+            text += f"... и ещё {referral_info['referrals_count'] - 5} пользователей\n"
     
-    from ui import get_referral_stats_keyboard
     reply_markup = get_referral_stats_keyboard()
     
     # Удаляем старое сообщение и отправляем новое
@@ -529,19 +497,16 @@ async def show_referral_stats(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
     return REFERRAL_MENU
 
+async def referral_link_for(bot, user_id: int) -> str:
+    """Реферальная ссылка пользователя; username бота известен после initialize, код кэшируется"""
+    return f"https://t.me/{bot.username}?start={await database.ensure_referral_code(user_id)}"
+
 async def generate_referral_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Генерирует и показывает реферальную ссылку пользователя"""
     query = update.callback_query
     await query.answer()
     
-    user_id = update.effective_user.id
-    referral_code = await database.ensure_referral_code(user_id)
-    
-    # Получаем информацию о боте
-    bot_info = await context.bot.get_me()
-    bot_username = bot_info.username
-    
-    referral_link = f"https://t.me/{bot_username}?start={referral_code}"
+    referral_link = await referral_link_for(context.bot, update.effective_user.id)
     
     text = f"🔗 <b>Ваша реферальная ссылка</b>\n\n"
     text += f"<code>{referral_link}</code>\n\n"
@@ -550,7 +515,6 @@ async def generate_referral_link(update: Update, context: ContextTypes.DEFAULT_T
     text += "• Ваш друг получит <b>50 ⭐</b> за регистрацию\n"
     text += "• Вы получите <b>25 ⭐</b> за каждого приглашённого"
     
-    from ui import get_referral_stats_keyboard
     reply_markup = get_referral_stats_keyboard()
     
     # Удаляем старое сообщение и отправляем новое
@@ -564,27 +528,60 @@ async def generate_referral_link(update: Update, context: ContextTypes.DEFAULT_T
     return REFERRAL_MENU
 
 async def show_referral_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Показывает список рефералов пользователя"""
+    """Показывает список рефералов пользователя постранично.
+
+    callback_data страниц: ref_list:next|prev:<id записи-границы>:<номер первой строки>
+    """
     query = update.callback_query
     await query.answer()
     
     user_id = update.effective_user.id
-    referrals = await database.get_user_referrals(user_id)
+    paging = query.data.startswith("ref_list:")
+    
+    if paging:
+        _, direction, boundary_id, first_number = query.data.split(":")
+        backward = direction == "prev"
+        first_number = int(first_number)
+        referrals = await database.get_user_referrals(user_id, REFERRALS_PAGE_SIZE + 1, int(boundary_id), backward)
+        if backward:
+            has_prev = len(referrals) > REFERRALS_PAGE_SIZE
+            referrals = referrals[-REFERRALS_PAGE_SIZE:]
+            has_next = True
+            if not has_prev:
+                first_number = 1
+        else:
+            has_next = len(referrals) > REFERRALS_PAGE_SIZE
+            referrals = referrals[:REFERRALS_PAGE_SIZE]
+            has_prev = True
+    else:
+        first_number = 1
+        referrals = await database.get_user_referrals(user_id, REFERRALS_PAGE_SIZE + 1)
+        has_next = len(referrals) > REFERRALS_PAGE_SIZE
+        referrals = referrals[:REFERRALS_PAGE_SIZE]
+        has_prev = False
     
     if not referrals:
         text = "📋 <b>Ваши рефералы</b>\n\nУ вас пока нет приглашённых пользователей.\n\n"
         text += "🔗 Поделитесь своей реферальной ссылкой с друзьями!"
+        prev_cursor = next_cursor = None
     else:
+        referral_info = await database.get_user_referral_info(user_id)
         text = f"📋 <b>Ваши рефералы</b>\n\n"
-        text += f"Всего приглашённых: <b>{len(referrals)}</b>\n\n"
+        text += f"Всего приглашённых: <b>{referral_info['referrals_count']}</b>\n\n"
         
-        for i, referral in enumerate(referrals, 1):
+        for i, referral in enumerate(referrals, first_number):
             name = referral['nickname'] or referral['username'] or f"Пользователь {referral['referred_id']}"
             date = referral['created_at'].split()[0] if referral['created_at'] else "Неизвестно"
             text += f"{i}. <b>{name}</b> - {date}\n"
+        
+        prev_cursor = (referrals[0]['id'], first_number - REFERRALS_PAGE_SIZE) if has_prev else None
+        next_cursor = (referrals[-1]['id'], first_number + len(referrals)) if has_next else None
     
-    from ui import get_referral_stats_keyboard
-    reply_markup = get_referral_stats_keyboard()
+    reply_markup = get_referral_list_keyboard(prev_cursor, next_cursor)
+    
+    if paging:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='HTML')
+        return REFERRAL_MENU
     
     # Удаляем старое сообщение и отправляем новое
     await query.delete_message()
@@ -594,4 +591,4 @@ async def show_referral_list(update: Update, context: ContextTypes.DEFAULT_TYPE)
         reply_markup=reply_markup,
         parse_mode='HTML'
     )
-    return REFERRAL_MENU
\ No newline at end of file
+    return REFERRAL_MENU
@@ -0,0 +1,83 @@
+from bisect import bisect_left, insort
+
+class Leaderboard:
+    """Топ игроков по балансу в памяти.
+
+    Хранит не больше size пар (-balance, user_id) — точный топ среди всех
+    пользователей: любой игрок вне топа стоит ниже последнего в нем. Игрок,
+    выпавший из заполненного топа, возвращается только с балансом выше
+    последнего места, а если топ поредел — рейтинг перечитывается из БД
+    (см. covers). Имена хранятся только для участников топа.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.loaded = False
+        # В топе все пользователи БД: новых можно добавлять без сравнения с последним местом
+        self.complete = False
+        self._entries: list[tuple[int, int]] = []
+        self._balances: dict[int, int] = {}
+        self._names: dict[int, tuple[str | None, str | None]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self, rows) -> None:
+        """Заполняет рейтинг первыми size парами (user_id, balance) по убыванию баланса"""
+        self._balances = {user_id: balance for user_id, balance in rows}
+        self._entries = sorted((-balance, user_id) for user_id, balance in self._balances.items())
+        self.complete = len(self._entries) < self.size
+        self._names.clear()
+        self.loaded = True
+
+    def update(self, user_id: int, balance: int) -> None:
+        old = self._balances.get(user_id)
+        if old == balance:
+            return
+        if old is not None:
+            del self._entries[bisect_left(self._entries, (-old, user_id))]
+            del self._balances[user_id]
+        entry = (-balance, user_id)
+        # Вне топа могут быть неизвестные игроки, но все они ниже последнего места
+        if not self.complete and not (self._entries and entry < self._entries[-1]):
+            self._names.pop(user_id, None)
+            return
+        insort(self._entries, entry)
+        self._balances[user_id] = balance
+        if len(self._entries) > self.size:
+            _, evicted = self._entries.pop()
+            del self._balances[evicted]
+            self._names.pop(evicted, None)
+            self.complete = False
+
+    def covers(self, limit: int) -> bool:
+        """Хватает ли игроков в памяти, чтобы показать первые limit мест"""
+        return self.complete or len(self._entries) >= limit
+
+    def top(self, limit: int) -> list[tuple[int, int]]:
+        """Возвращает до limit пар (user_id, balance) по убыванию баланса"""
+        return [(user_id, -neg_balance) for neg_balance, user_id in self._entries[:limit]]
+
+    def rank(self, user_id: int) -> int | None:
+        """Место игрока, если он в топе; для остальных место считает БД"""
+        balance = self._balances.get(user_id)
+        if balance is None:
+            return None
+        return bisect_left(self._entries, (-balance, user_id)) + 1
+
+    def missing_names(self, user_ids) -> list[int]:
+        return [user_id for user_id in user_ids if user_id not in self._names]
+
+    def set_names(self, user_id: int, username: str | None, nickname: str | None) -> None:
+        self._names[user_id] = (username, nickname)
+
+    def update_names(self, user_id: int, username: str | None = None, nickname: str | None = None) -> None:
+        """Обновляет имя, только если пользователь уже отображался в топе"""
+        current = self._names.get(user_id)
+        if current is None:
+            return
+        self._names[user_id] = (username if username is not None else current[0],
+                                nickname if nickname is not None else current[1])
+
+    def names(self, user_id: int) -> tuple[str | None, str | None]:
+        return self._names.get(user_id, (None, None))
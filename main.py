@@ -10,11 +10,21 @@ from telegram.ext import (
     filters,
 )
 
-from config import TELEGRAM_TOKEN
+from config import (
+    TELEGRAM_TOKEN, BOT_API_URL, MAX_CONCURRENT_UPDATES, BOT_MODE, UPDATE_QUEUE_SIZE, BOT_WORKERS,
+    PERSISTENCE_PATH, PERSISTENCE_INTERVAL, METRICS_LISTEN, METRICS_PORT,
+)
+from update_processor import PerUserUpdateProcessor
+from persistence import SqlitePersistence
 import database
 import handlers
 import payments
 import admin
+import broadcast
+import webhook
+import sharding
+import metrics
+import profiler
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -22,16 +32,74 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+_backfill_task: asyncio.Task | None = None
+_metrics_server: metrics.MetricsServer | None = None
+
+async def backfill_referral_codes() -> None:
+    try:
+        updated = await database.backfill_referral_codes()
+    except Exception as e:
+        logger.error(f"Ошибка выдачи реферальных кодов: {e}")
+        return
+    if updated:
+        logger.info(f"Реферальные коды выданы {updated} пользователям.")
+
 async def post_init(application: Application) -> None:
-    await database.init_db()
+    await database.init_pool()
+    # Шарды работают с уже подготовленной БД: миграции выполнил фронт-процесс (sharding.run)
+    if sharding.current_shard is None:
+        await database.init_db()
+    await database.load_leaderboard()
+    database.start_bet_ledger()
     logger.info("База данных успешно инициализирована.")
+    if METRICS_PORT:
+        global _metrics_server
+        _metrics_server = metrics.MetricsServer(METRICS_LISTEN, METRICS_PORT + (sharding.current_shard or 0))
+        await _metrics_server.start()
+    # При нескольких процессах фоновые задачи выполняет только первый шард
+    if sharding.current_shard in (None, 0):
+        await broadcast.resume_broadcasts(application.bot)
+        global _backfill_task
+        _backfill_task = asyncio.create_task(backfill_referral_codes(), name="referral_code_backfill")
 
-def main() -> None:
+async def post_stop(application: Application) -> None:
+    await broadcast.stop_broadcasts()
+    await profiler.stop_sessions()
+    if _backfill_task:
+        _backfill_task.cancel()
+        await asyncio.gather(_backfill_task, return_exceptions=True)
+
+async def post_shutdown(application: Application) -> None:
+    # Дописываем журнал ставок до закрытия соединений
+    await database.flush_bet_ledger()
+    await database.close_pool()
+    if _metrics_server:
+        await _metrics_server.stop()
+
+def build_application(updater: bool = True) -> Application:
+    """Создает приложение со всеми обработчиками; updater=False — обновления подаются извне"""
     builder = Application.builder().token(TELEGRAM_TOKEN)
+    builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
     builder.post_init(post_init)
+    builder.post_stop(post_stop)
+    builder.post_shutdown(post_shutdown)
+    # Разные пользователи обслуживаются параллельно, обновления одного пользователя — по порядку
+    builder.concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    # Ограниченная очередь: при перегрузке webhook-сервер перестает отвечать и Telegram притормаживает доставку
+    builder.update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+    # Задержка каждого запроса к Bot API попадает в метрики
+    builder.request(metrics.TimedRequest(connection_pool_size=256))
+    if updater:
+        builder.get_updates_request(metrics.TimedRequest())
+    else:
+        builder.updater(None)
+    # Игроки остаются в своих диалогах после перезапуска; состояние пишется пачками раз в PERSISTENCE_INTERVAL
+    builder.persistence(SqlitePersistence(sharding.shard_path(PERSISTENCE_PATH), PERSISTENCE_INTERVAL))
     application = builder.build()
 
     game_conv = ConversationHandler(
+        name='game',
+        persistent=True,
         entry_points=[CallbackQueryHandler(handlers.play_game, pattern='^play$')],
         states={
             handlers.GAME_CHOICE: [CallbackQueryHandler(handlers.choose_game, pattern='^game_')],
@@ -48,6 +116,8 @@ def main() -> None:
         map_to_parent={ ConversationHandler.END: handlers.MAIN_MENU }
     )
     deposit_conv = ConversationHandler(
+        name='deposit',
+        persistent=True,
         entry_points=[CallbackQueryHandler(payments.deposit_start, pattern='^deposit$')],
         states={
             payments.CHOOSE_AMOUNT: [CallbackQueryHandler(payments.select_deposit_amount, pattern='^deposit_')],
@@ -58,6 +128,8 @@ def main() -> None:
         map_to_parent={ ConversationHandler.END: handlers.MAIN_MENU }
     )
     withdraw_conv = ConversationHandler(
+        name='withdraw',
+        persistent=True,
         entry_points=[CallbackQueryHandler(handlers.withdraw, pattern='^withdraw$')],
         states={
             handlers.WITHDRAW_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.process_withdrawal_amount)],
@@ -67,6 +139,8 @@ def main() -> None:
         map_to_parent={ ConversationHandler.END: handlers.MAIN_MENU }
     )
     set_nickname_conv = ConversationHandler(
+        name='set_nickname',
+        persistent=True,
         entry_points=[CallbackQueryHandler(handlers.request_nickname, pattern='^set_nickname$')],
         states={
             handlers.SETTING_NICKNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.save_nickname)],
@@ -77,6 +151,8 @@ def main() -> None:
     )
 
     main_handler = ConversationHandler(
+        name='main',
+        persistent=True,
         entry_points=[CommandHandler('start', handlers.start)],
         states={
             handlers.MAIN_MENU: [
@@ -93,7 +169,7 @@ def main() -> None:
             handlers.REFERRAL_MENU: [
                 CallbackQueryHandler(handlers.show_referral_stats, pattern='^show_referral_stats$'),
                 CallbackQueryHandler(handlers.generate_referral_link, pattern='^generate_referral_link$'),
-                CallbackQueryHandler(handlers.show_referral_list, pattern='^show_referral_list$'),
+                CallbackQueryHandler(handlers.show_referral_list, pattern='^(show_referral_list$|ref_list:)'),
                 CallbackQueryHandler(handlers.referral_system, pattern='^referral_system$'),
                 CallbackQueryHandler(handlers.back_to_menu, pattern='^back_to_start$'),
             ]
@@ -115,9 +191,25 @@ def main() -> None:
     application.add_handler(CommandHandler('sub_balance', admin.subtract_from_balance))
     application.add_handler(CommandHandler('broadcast', admin.broadcast_message))
     application.add_handler(CommandHandler('server_stats', admin.show_server_stats))
+    application.add_handler(CommandHandler('reconcile_stats', admin.reconcile_server_stats))
+    application.add_handler(CommandHandler('profile', admin.profile_bot))
+
+    metrics.instrument_application(application)
+    metrics.instrument_module(database)
+    return application
+
+def main() -> None:
+    if BOT_WORKERS > 1:
+        logger.info(f"Бот запущен в режиме {BOT_MODE}, процессов: {BOT_WORKERS}...")
+        sharding.run(build_application, BOT_WORKERS)
+        return
 
-    logger.info("Бот запущен...")
-    application.run_polling(allowed_updates=True)
+    application = build_application(updater=BOT_MODE != "webhook")
+    logger.info(f"Бот запущен в режиме {BOT_MODE}...")
+    if BOT_MODE == "webhook":
+        webhook.run(application)
+    else:
+        application.run_polling(allowed_updates=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
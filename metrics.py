@@ -0,0 +1,282 @@
+import asyncio
+import inspect
+import logging
+import time
+from bisect import bisect_left
+from functools import wraps
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# ==================== ХРАНЕНИЕ ====================
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, как histogram в Prometheus"""
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+class Registry:
+    """Метрики процесса: гистограммы и счетчики с метками, датчики — функции, читаемые при выгрузке"""
+
+    def __init__(self):
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.gauges: dict[str, tuple[str, object]] = {}
+        self.help: dict[str, str] = {}
+
+    def describe(self, name: str, text: str):
+        self.help[name] = text
+
+    def observe(self, name: str, value: float, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = tuple(labels.items())
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(labels.items())
+        series[key] = series.get(key, 0) + amount
+
+    def gauge(self, name: str, read, text: str = ""):
+        self.gauges[name] = (text, read)
+
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+
+        def header(name: str, kind: str):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name, series in sorted(self.counters.items()):
+            header(name, "counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{_labels(labels)} {value}")
+        for name, (text, read) in sorted(self.gauges.items()):
+            try:
+                value = read()
+            except Exception as e:
+                logger.debug(f"Не удалось прочитать метрику {name}: {e}")
+                continue
+            self.help.setdefault(name, text)
+            header(name, "gauge")
+            lines.append(f"{name} {value}")
+        for name, series in sorted(self.histograms.items()):
+            header(name, "histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, bucket_count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def top(self, name: str, limit: int = 5) -> list[tuple[dict, Histogram]]:
+        """Серии гистограммы с наибольшим суммарным временем"""
+        series = self.histograms.get(name, {})
+        ordered = sorted(series.items(), key=lambda item: item[1].sum, reverse=True)
+        return [(dict(labels), histogram) for labels, histogram in ordered[:limit]]
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+registry = Registry()
+registry.describe("bot_update_seconds", "Время обработки обновления, включая ожидание предыдущих обновлений пользователя")
+registry.describe("bot_handler_seconds", "Время работы обработчика")
+registry.describe("bot_handler_errors_total", "Исключения в обработчиках")
+registry.describe("bot_conversation_state_seconds", "Время обработчиков по состоянию диалога")
+registry.describe("bot_db_call_seconds", "Время вызова функций database (число вызовов — _count)")
+registry.describe("bot_db_call_errors_total", "Исключения в функциях database")
+registry.describe("bot_db_queries_total", "Выполненные SQL-запросы")
+registry.describe("bot_db_slow_queries_total", "SQL-запросы дольше DB_SLOW_QUERY_MS")
+registry.describe("bot_bet_ledger_lost_total", "Ставки, не записанные в журнал bets после всех попыток")
+registry.describe("bot_api_request_seconds", "Задержка запросов к Bot API")
+registry.describe("bot_api_request_errors_total", "Неудачные запросы к Bot API")
+
+# ==================== ИНСТРУМЕНТИРОВАНИЕ ====================
+
+def _timed(callback, on_done):
+    """Оборачивает корутину: on_done(секунды, failed) вызывается после каждого вызова"""
+    @wraps(callback)
+    async def wrapped(*args, **kwargs):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = await callback(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            on_done(time.perf_counter() - start, failed)
+    wrapped._metrics_timed = True
+    return wrapped
+
+def _timed_handler(callback, conversation: str | None = None, state: object = None):
+    name = callback.__name__
+
+    def on_done(elapsed: float, failed: bool):
+        registry.observe("bot_handler_seconds", elapsed, handler=name)
+        if conversation:
+            registry.observe("bot_conversation_state_seconds", elapsed, conversation=conversation, state=state)
+        if failed:
+            registry.inc("bot_handler_errors_total", handler=name)
+
+    return _timed(callback, on_done)
+
+def _instrument_handlers(handlers, conversation: str | None = None, state: object = None):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            name = handler.name or "conversation"
+            _instrument_handlers(handler.entry_points, name, "entry")
+            for handler_state, state_handlers in handler.states.items():
+                _instrument_handlers(state_handlers, name, handler_state)
+            _instrument_handlers(handler.fallbacks, name, "fallback")
+        elif not getattr(handler.callback, "_metrics_timed", False):
+            handler.callback = _timed_handler(handler.callback, conversation, state)
+
+def instrument_application(application):
+    """Замеряет все обработчики приложения, включая вложенные ConversationHandler"""
+    for group_handlers in application.handlers.values():
+        _instrument_handlers(group_handlers)
+    registry.gauge("bot_update_queue_size", application.update_queue.qsize, "Обновлений в очереди приложения")
+    registry.gauge(
+        "bot_updates_in_flight", lambda: application.update_processor.current_concurrent_updates,
+        "Обновлений в обработке (без ожидающих своей очереди у пользователя)",
+    )
+
+def instrument_module(module, histogram: str = "bot_db_call_seconds", errors: str = "bot_db_call_errors_total"):
+    """Замеряет публичные корутины модуля (вызовы идут через атрибуты модуля, поэтому подмены достаточно)"""
+    for name, function in list(vars(module).items()):
+        if (name.startswith("_") or not inspect.iscoroutinefunction(function)
+                or function.__module__ != module.__name__ or getattr(function, "_metrics_timed", False)):
+            continue
+
+        def on_done(elapsed: float, failed: bool, name=name):
+            registry.observe(histogram, elapsed, function=name)
+            if failed:
+                registry.inc(errors, function=name)
+
+        setattr(module, name, _timed(function, on_done))
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest, записывающий задержку каждого запроса к Bot API по имени метода"""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            registry.inc("bot_api_request_errors_total", method=api_method)
+            raise
+        finally:
+            registry.observe("bot_api_request_seconds", time.perf_counter() - start, method=api_method)
+        if code >= 400:
+            registry.inc("bot_api_request_errors_total", method=api_method)
+        return code, payload
+
+# ==================== ВЫГРУЗКА ====================
+
+class MetricsServer:
+    """Отдает registry.render() по GET /metrics"""
+
+    def __init__(self, listen: str, port: int):
+        self.listen = listen
+        self.port = port
+        self._server: asyncio.base_events.Server | None = None
+
+    async def start(self):
+        try:
+            self._server = await asyncio.start_server(self._handle, self.listen, self.port)
+        except OSError as e:
+            logger.error(f"Не удалось открыть /metrics на {self.listen}:{self.port}: {e}")
+            return
+        logger.info(f"Метрики доступны на http://{self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split(" ")
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?", 1)[0] == "/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b""
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+def summary(limit: int = 5) -> str:
+    """Краткая сводка для /server_stats: где уходит время"""
+    def ms(seconds: float) -> str:
+        return f"{seconds * 1000:.1f}"
+
+    def section(title: str, name: str, label: str, skip=()) -> list[str]:
+        rows = [(labels, h) for labels, h in registry.top(name, limit + len(skip)) if labels.get(label) not in skip][:limit]
+        if not rows:
+            return []
+        return [f"<b>{title}</b> (вызовов, p50/p95 мс, всего сек.):"] + [
+            f"{labels[label]}: {h.count}, {ms(h.quantile(0.5))}/{ms(h.quantile(0.95))}, {h.sum:.1f}"
+            for labels, h in rows
+        ]
+
+    updates = registry.histograms.get("bot_update_seconds", {}).get((), Histogram())
+    in_flight = registry.gauges.get("bot_updates_in_flight")
+    lines = [
+        f"Обновлений: {updates.count}, p50/p95: {ms(updates.quantile(0.5))}/{ms(updates.quantile(0.95))} мс"
+        + (f", в обработке: {in_flight[1]()}" if in_flight else "")
+    ]
+    lines += section("Обработчики", "bot_handler_seconds", "handler")
+    lines += section("БД", "bot_db_call_seconds", "function")
+    # getUpdates — long polling, его задержка ничего не говорит о скорости API
+    lines += section("Bot API", "bot_api_request_seconds", "method", skip=("getUpdates",))
+    return "\n".join(lines)
@@ -1,6 +1,7 @@
 import logging
-import time
+import secrets
 from telegram import Update, LabeledPrice, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import ContextTypes, ConversationHandler
 import database
 from ui import get_deposit_options_keyboard, get_back_to_menu_keyboard_nested
@@ -47,13 +48,14 @@ async def create_and_send_payment_link(update: Update, context: ContextTypes.DEF
     title = "Пополнение баланса казино"
     description = f"Пополнение вашего игрового счета на {amount} ⭐"
     
-    timestamp = int(time.time())
-    payload = f"casino-deposit-{update.effective_user.id}-{timestamp}"
+    # Случайная часть вместо времени: два счета, выставленные в одну секунду, не совпадут
+    payload = f"casino-deposit-{update.effective_user.id}-{secrets.token_hex(8)}"
     
     currency = "XTR"
     prices = [LabeledPrice("Игровые звезды", amount)]
 
     try:
+        await database.create_invoice(payload, update.effective_user.id, amount)
         link = await context.bot.create_invoice_link(title, description, payload, currency, prices)
         
         text = (f"Для пополнения баланса на <b>{amount} ⭐</b>, нажмите кнопку ниже.\n\n"
@@ -81,8 +83,9 @@ async def create_and_send_payment_link(update: Update, context: ContextTypes.DEF
 
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.pre_checkout_query
-    if not query.invoice_payload.startswith('casino-deposit-'):
-        await query.answer(ok=False, error_message="Что-то пошло не так...")
+    if query.currency != "XTR" or not await database.is_pending_invoice(query.invoice_payload, query.from_user.id, query.total_amount):
+        await query.answer(ok=False, error_message="Счет недействителен или уже оплачен. Создайте новый.")
+        logger.warning(f"Отклонен pre-checkout пользователя {query.from_user.id}: {query.invoice_payload}")
     else:
         await query.answer(ok=True)
         logger.info(f"Подтвержден pre-checkout для пользователя {query.from_user.id}")
@@ -92,12 +95,33 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
     payment = update.message.successful_payment
     amount = payment.total_amount
     
-    await database.update_user_balance(user.id, amount, relative=True)
-    new_balance = await database.get_user_balance(user.id)
+    try:
+        new_balance = await database.credit_payment(payment.telegram_payment_charge_id, payment.invoice_payload, user.id, amount)
+    except database.PaymentRejectedError as e:
+        await refund_rejected_payment(context, user.id, payment.telegram_payment_charge_id, amount, e)
+        return
+    if new_balance is None:
+        logger.info(f"Платеж {payment.telegram_payment_charge_id} уже зачислен, повторная доставка пропущена.")
+        return
     
     logger.info(f"Пользователь {user.id} успешно пополнил баланс на {amount} ⭐.")
     await context.bot.send_message(
         chat_id=user.id,
         text=f"✅ Оплата прошла успешно!\n\nНа ваш счет зачислено: <b>{amount}</b> ⭐\nВаш новый баланс: <b>{new_balance}</b> ⭐",
         parse_mode='HTML'
-    )
\ No newline at end of file
+    )
+
+async def refund_rejected_payment(context: ContextTypes.DEFAULT_TYPE, user_id: int, charge_id: str, amount: int, reason: Exception) -> None:
+    """Возвращает звезды за платеж, который не удалось зачислить, и сообщает об этом пользователю"""
+    logger.warning(f"{reason}: возвращаем {amount} ⭐ пользователю {user_id}.")
+    try:
+        await context.bot.refund_star_payment(user_id, charge_id)
+    except TelegramError as e:
+        logger.error(f"Не удалось вернуть платеж {charge_id} пользователю {user_id}, нужен ручной возврат: {e}")
+        text = ("⚠️ Счет уже оплачен или недействителен, поэтому оплата не зачислена.\n\n"
+                "Автоматически вернуть звезды не удалось — обратитесь в поддержку.")
+    else:
+        await database.mark_payment_refunded(charge_id)
+        text = (f"⚠️ Счет уже оплачен или недействителен, поэтому оплата не зачислена.\n\n"
+                f"<b>{amount}</b> ⭐ возвращены вам через Telegram.")
+    await context.bot.send_message(chat_id=user_id, text=text, parse_mode='HTML')
\ No newline at end of file
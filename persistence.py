@@ -0,0 +1,161 @@
+import asyncio
+import json
+import logging
+import pickle
+import aiosqlite
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+class SqlitePersistence(BasePersistence):
+    """Хранит user_data и состояния ConversationHandler в отдельном файле SQLite.
+
+    Application сам копит измененные записи и передает их сюда раз в update_interval
+    секунд; все записи одного прохода сохраняются одной транзакцией. chat_data,
+    bot_data и callback_data бот не использует, поэтому они не сохраняются.
+    """
+
+    def __init__(self, filepath: str, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.filepath = filepath
+        self._db: aiosqlite.Connection | None = None
+        self._user_data: dict[int, dict | None] = {}
+        self._conversations: dict[tuple[str, str], object] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._write_lock = asyncio.Lock()
+
+    async def _get_db(self) -> aiosqlite.Connection:
+        if self._db is None:
+            self._db = await aiosqlite.connect(self.filepath)
+            await self._db.execute("PRAGMA journal_mode = WAL")
+            await self._db.execute("PRAGMA synchronous = NORMAL")
+            await self._db.execute("CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+            await self._db.execute('''
+                CREATE TABLE IF NOT EXISTS conversations (
+                    name TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    state BLOB NOT NULL,
+                    PRIMARY KEY (name, key)
+                )
+            ''')
+            await self._db.commit()
+        return self._db
+
+    # ---------- Загрузка при старте ----------
+
+    async def get_user_data(self) -> dict[int, dict]:
+        db = await self._get_db()
+        cursor = await db.execute("SELECT user_id, data FROM user_data")
+        return {user_id: pickle.loads(data) for user_id, data in await cursor.fetchall()}
+
+    async def get_conversations(self, name: str) -> dict:
+        db = await self._get_db()
+        cursor = await db.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in await cursor.fetchall()}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    # ---------- Запись: накапливаем и сохраняем пачкой ----------
+
+    def _schedule_flush(self):
+        # Application вызывает update_* для всех измененных записей разом через gather,
+        # поэтому запись откладывается до конца текущей итерации цикла событий
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_soon(), name="persistence_flush")
+
+    async def _flush_soon(self):
+        await asyncio.sleep(0)
+        self._flush_task = None
+        try:
+            await self._write_pending()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить состояние диалогов: {e}")
+
+    async def _write_pending(self):
+        async with self._write_lock:
+            if self._user_data or self._conversations:
+                await self._write_batch()
+
+    async def _write_batch(self):
+        user_data, self._user_data = self._user_data, {}
+        conversations, self._conversations = self._conversations, {}
+
+        db = await self._get_db()
+        try:
+            await db.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                [(user_id, pickle.dumps(data)) for user_id, data in user_data.items() if data],
+            )
+            # Пустой user_data не храним
+            await db.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, data in user_data.items() if not data],
+            )
+            await db.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                [(name, key, pickle.dumps(state)) for (name, key), state in conversations.items() if state is not None],
+            )
+            await db.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [(name, key) for (name, key), state in conversations.items() if state is None],
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            # Не теряем изменения: более свежие значения, пришедшие за время записи, важнее
+            self._user_data = {**user_data, **self._user_data}
+            self._conversations = {**conversations, **self._conversations}
+            raise
+        logger.debug(f"Сохранено состояние: user_data {len(user_data)}, диалогов {len(conversations)}.")
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._user_data[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._user_data[user_id] = None
+        self._schedule_flush()
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        self._conversations[(name, json.dumps(key))] = new_state
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Дописывает накопленное и закрывает файл (вызывается при остановке Application)"""
+        if self._flush_task:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._write_pending()
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
@@ -0,0 +1,85 @@
+import asyncio
+import cProfile
+import os
+import pstats
+import tempfile
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_active: cProfile.Profile | None = None
+_stop: asyncio.Event | None = None
+_tasks: set[asyncio.Task] = set()
+
+def is_running() -> bool:
+    return _active is not None
+
+async def run_session(seconds: float) -> tuple[str, str]:
+    """Профилирует поток цикла событий seconds секунд; возвращает сводку и путь к файлу .prof.
+
+    В поток цикла событий попадают все обработчики и фоновые задачи бота; запросы
+    SQLite выполняются в потоках aiosqlite и видны только как ожидание.
+    stop_sessions завершает сессию досрочно, сводка строится по собранному.
+    """
+    global _active, _stop
+    if _active is not None:
+        raise RuntimeError("Профилирование уже идет")
+    profile = _active = cProfile.Profile()
+    stop = _stop = asyncio.Event()
+    try:
+        profile.enable()
+        try:
+            await asyncio.wait_for(stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            profile.disable()
+    finally:
+        _active = _stop = None
+
+    fd, path = tempfile.mkstemp(prefix="casino_profile_", suffix=".prof")
+    os.close(fd)
+    profile.dump_stats(path)
+    return summarize(pstats.Stats(profile)), path
+
+def start_session(coroutine) -> asyncio.Task:
+    """Запускает сессию с отправкой отчета в фоне, вне задач Application.
+
+    Application.stop() ждет свои задачи, а сессия может длиться минуты; эту
+    задачу при остановке бота завершает stop_sessions.
+    """
+    task = asyncio.create_task(coroutine, name="profile_session")
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+async def stop_sessions():
+    """Досрочно завершает идущую сессию и ждет отправки частичного отчета"""
+    if _stop is not None:
+        _stop.set()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+
+def _function_name(filename: str, line: int, name: str) -> str:
+    if filename == "~":
+        # Встроенные функции: имя уже в виде <built-in method ...>
+        return name
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+def summarize(stats: pstats.Stats, limit: int = 10) -> str:
+    """Топ функций бота по cumulative и всех функций по собственному времени"""
+    rows = [
+        (filename, line, name, calls, tottime, cumtime)
+        for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items()
+    ]
+
+    def table(title: str, selected, column: int) -> list[str]:
+        lines = [title, f"{'мс':>8} {'вызовов':>8}  функция"]
+        for row in sorted(selected, key=lambda row: row[column], reverse=True)[:limit]:
+            filename, line, name, calls = row[:4]
+            lines.append(f"{row[column] * 1000:>8.0f} {calls:>8}  {_function_name(filename, line, name)}")
+        return lines
+
+    own_code = [row for row in rows if row[0].startswith(PROJECT_DIR) and row[0] != __file__]
+    lines = table("Код бота, суммарное время (cumulative):", own_code, 5)
+    lines.append("")
+    lines += table("Все функции, собственное время (tottime):", rows, 4)
+    return "\n".join(lines)
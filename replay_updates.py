@@ -0,0 +1,97 @@
+"""Отправляет записанные обновления Telegram на локальный webhook и измеряет задержку ответа.
+
+Пример:
+    python replay_updates.py updates.jsonl --repeat 10 --concurrency 20
+
+Файл содержит по одному JSON-обновлению на строку (или JSON-массив обновлений).
+Адрес, путь и секрет по умолчанию берутся из той же конфигурации, что и бот.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from urllib.parse import urlsplit
+from config import WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN
+
+def load_updates(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        text = f.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+async def _post(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, path: str, body: bytes, headers: dict) -> int:
+    """Отправляет POST по открытому keep-alive соединению и возвращает код ответа"""
+    head = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n{head}\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+    return status
+
+async def replay(url: str, updates: list[dict], repeat: int, concurrency: int, secret_token: str | None) -> list[float]:
+    # Клиент намеренно минимальный: накладные расходы HTTP-библиотеки искажали бы измерение
+    parsed = urlsplit(url)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret_token} if secret_token else {}
+    # update_id у повторов должен расти, иначе запись неотличима от повторной доставки
+    update_ids = itertools.count(max((u.get("update_id", 0) for u in updates), default=0) + 1)
+    queue = asyncio.Queue()
+    for _ in range(repeat):
+        for update in updates:
+            queue.put_nowait(json.dumps(dict(update, update_id=next(update_ids))).encode())
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(parsed.hostname, parsed.port or 80)
+        try:
+            while not queue.empty():
+                body = queue.get_nowait()
+                start = time.perf_counter()
+                status = await _post(reader, writer, parsed.netloc, parsed.path or "/", body, headers)
+                latencies.append(time.perf_counter() - start)
+                if status != 200:
+                    errors += 1
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    if errors:
+        print(f"Ответов с ошибкой: {errors}")
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="файл с записанными обновлениями")
+    parser.add_argument("--url", default=f"http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH.lstrip('/')}")
+    parser.add_argument("--secret-token", default=WEBHOOK_SECRET_TOKEN)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    updates = load_updates(args.file)
+    start = time.perf_counter()
+    latencies = asyncio.run(replay(args.url, updates, args.repeat, args.concurrency, args.secret_token))
+    duration = time.perf_counter() - start
+
+    print(f"Отправлено обновлений: {len(latencies)} за {duration:.2f} сек. ({len(latencies) / duration:.0f}/сек)")
+    for p in (50, 95, 99):
+        print(f"p{p}: {percentile(latencies, p) * 1000:.1f} мс")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+from functools import partial
+from telegram import Bot, Update
+from telegram.error import TelegramError
+from config import TELEGRAM_TOKEN, BOT_API_URL, BOT_MODE, UPDATE_QUEUE_SIZE, LEADERBOARD_REFRESH_INTERVAL
+from update_processor import raw_ordering_key
+import database
+import webhook
+
+logger = logging.getLogger(__name__)
+
+# Номер шарда текущего процесса; None — бот работает одним процессом
+current_shard: int | None = None
+
+# У каждого шарда две очереди: ограниченная для обновлений (json обновления) и неограниченная
+# управляющая для сброса кэша (user_id). None в очереди означает остановку
+WORKER_STOP_TIMEOUT = 30
+WORKER_CHECK_INTERVAL = 1
+
+def shard_for(key: int | None, count: int) -> int:
+    return key % count if key is not None else 0
+
+def shard_path(path: str) -> str:
+    """Добавляет к имени файла номер шарда: bot_state.db -> bot_state.shard1.db"""
+    if current_shard is None:
+        return path
+    root, dot, ext = path.rpartition(".")
+    return f"{root}.shard{current_shard}.{ext}" if dot else f"{path}.shard{current_shard}"
+
+# ---------- Процесс-обработчик ----------
+
+async def _receive(source: multiprocessing.Queue):
+    """Следующее сообщение межпроцессной очереди, не блокируя цикл событий"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            # С таймаутом, чтобы поток исполнителя не зависал на get() после остановки
+            return await loop.run_in_executor(None, source.get, True, 1)
+        except queue.Empty:
+            continue
+
+async def _consume(application, inbox: multiprocessing.Queue):
+    """Перекладывает обновления из межпроцессной очереди в очередь обновлений приложения"""
+    while (data := await _receive(inbox)) is not None:
+        try:
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            # Одно битое обновление не должно останавливать весь шард
+            logger.error(f"Пропущено некорректное обновление {data.get('update_id')}: {e}")
+            continue
+        await application.update_queue.put(update)
+
+async def _consume_invalidations(control: multiprocessing.Queue):
+    """Сбрасывает кэш пользователей, измененных другими процессами.
+
+    Отдельная очередь: сброс не ждет обновлений, накопившихся перед ним, и не теряется при их переполнении.
+    """
+    while (user_id := await _receive(control)) is not None:
+        database.forget_user(user_id)
+
+async def _refresh_leaderboard():
+    """Свои изменения попадают в рейтинг сразу, чужие — при периодической перезагрузке.
+
+    Перечитывается только топ (LEADERBOARD_SIZE строк по idx_users_balance), поэтому
+    перезагрузка занимает доли миллисекунды и не задерживает цикл событий шарда.
+    """
+    while True:
+        await asyncio.sleep(LEADERBOARD_REFRESH_INTERVAL)
+        try:
+            await database.load_leaderboard()
+        except Exception as e:
+            logger.error(f"Не удалось обновить рейтинг: {e}")
+
+async def _serve_worker(application, inbox: multiprocessing.Queue, control: multiprocessing.Queue):
+    async with webhook.running(application):
+        tasks = (
+            asyncio.create_task(_refresh_leaderboard(), name="leaderboard_refresh"),
+            asyncio.create_task(_consume_invalidations(control), name="shard_invalidations"),
+        )
+        consume_task = asyncio.create_task(_consume(application, inbox), name="shard_consume")
+        stop_task = asyncio.create_task(webhook.wait_for_stop_signal((signal.SIGTERM,)))
+        try:
+            await asyncio.wait((consume_task, stop_task), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (*tasks, consume_task, stop_task):
+                task.cancel()
+            await asyncio.gather(*tasks, consume_task, stop_task, return_exceptions=True)
+
+def _worker_main(index: int, inboxes: list[multiprocessing.Queue], controls: list[multiprocessing.Queue], build_application):
+    global current_shard
+    # Ctrl+C получает вся группа процессов; останавливает обработчики фронт-процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    current_shard = index
+    count = len(inboxes)
+
+    def notify_owner(user_id: int):
+        # Управляющая очередь не ограничена, put_nowait не бросает queue.Full
+        controls[shard_for(user_id, count)].put_nowait(user_id)
+
+    database.configure_shard(index, count, notify_owner)
+    application = build_application(updater=False)
+    logger.info(f"Шард {index}/{count} запущен.")
+    asyncio.run(_serve_worker(application, inboxes[index], controls[index]))
+
+# ---------- Фронт-процесс ----------
+
+class ShardRouter:
+    """Направляет обновления в очередь шарда по user_id, сохраняя порядок в пределах пользователя"""
+
+    def __init__(self, inboxes: list[multiprocessing.Queue]):
+        self.inboxes = inboxes
+        self.closed = False
+
+    async def dispatch(self, data: dict):
+        try:
+            key = raw_ordering_key(data)
+        except (KeyError, TypeError) as e:
+            # Webhook-сервер ответит 400
+            raise ValueError(f"обновление {data.get('update_id')} без корректного отправителя: {e}") from e
+        inbox = self.inboxes[shard_for(key, len(self.inboxes))]
+        try:
+            inbox.put_nowait(data)
+            return
+        except queue.Full:
+            pass
+        # Шард не успевает: ждем места, не блокируя цикл событий.
+        # Таймаут — чтобы поток исполнителя не зависал на put() после остановки
+        loop = asyncio.get_running_loop()
+        while not self.closed:
+            try:
+                await loop.run_in_executor(None, inbox.put, data, True, 1)
+                return
+            except queue.Full:
+                continue
+        raise RuntimeError("Бот останавливается, обновление не принято")
+
+async def _watch_workers(processes: list[multiprocessing.Process]):
+    """Бросает исключение, как только завершился любой процесс-обработчик.
+
+    Перезапускать один шард небезопасно: убитый процесс мог умереть, держа
+    внутренний замок своей очереди, и новый процесс зависнет на get(). Поэтому
+    фронт останавливается вместе с остальными шардами, а бота перезапускает
+    внешний супервизор (systemd, docker).
+    """
+    while True:
+        await asyncio.sleep(WORKER_CHECK_INTERVAL)
+        for process in processes:
+            if not process.is_alive():
+                raise RuntimeError(f"{process.name} завершился с кодом {process.exitcode}, бот остановлен")
+
+async def _until_stopped(watch, *services: asyncio.Task):
+    """Ждет сигнала остановки.
+
+    Ошибка наблюдения за обработчиками или завершение любой из services (например,
+    опроса Bot API) пробрасывается наружу: фронт без них не получает обновлений.
+    """
+    stop_task = asyncio.create_task(webhook.wait_for_stop_signal())
+    watch_task = asyncio.create_task(watch(), name="watch_workers")
+    try:
+        done, _ = await asyncio.wait((stop_task, watch_task, *services), return_when=asyncio.FIRST_COMPLETED)
+        for task in (watch_task, *services):
+            if task in done:
+                task.result()
+                raise RuntimeError(f"Задача {task.get_name()} неожиданно завершилась, бот остановлен")
+    finally:
+        for task in (stop_task, watch_task):
+            task.cancel()
+        await asyncio.gather(stop_task, watch_task, return_exceptions=True)
+
+async def _poll(bot: Bot, router: ShardRouter):
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+        except TelegramError as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            try:
+                await router.dispatch(update.to_dict())
+            except Exception as e:
+                if router.closed:
+                    raise
+                # Одно плохое обновление не должно останавливать опрос
+                logger.error(f"Пропущено обновление {update.update_id}: {e}")
+            offset = update.update_id + 1
+
+async def _serve_front(router: ShardRouter, watch):
+    async with Bot(TELEGRAM_TOKEN, base_url=f"{BOT_API_URL}/bot", base_file_url=f"{BOT_API_URL}/file/bot") as bot:
+        if BOT_MODE == "webhook":
+            server = webhook.make_server(router.dispatch)
+            await server.start()
+            try:
+                await webhook.register_webhook(bot, server)
+                await _until_stopped(watch)
+            finally:
+                router.closed = True
+                await server.stop()
+        else:
+            await bot.delete_webhook()
+            poll_task = asyncio.create_task(_poll(bot, router), name="poll")
+            try:
+                await _until_stopped(watch, poll_task)
+            finally:
+                router.closed = True
+                poll_task.cancel()
+                await asyncio.gather(poll_task, return_exceptions=True)
+
+async def _prepare_db():
+    """Миграции выполняются один раз до запуска шардов, а не наперегонки в каждом процессе"""
+    await database.init_pool(readers=1)
+    try:
+        await database.init_db()
+    finally:
+        await database.close_pool()
+
+def run(build_application, workers: int):
+    """Запускает фронт-процесс и workers процессов-обработчиков.
+
+    Фронт получает обновления (polling или webhook) и раскладывает их по шардам
+    user_id % workers. Все процессы работают с одним файлом БД в режиме WAL:
+    записи сериализует SQLite, а кэш балансов у каждого свой (см. database.configure_shard).
+    """
+    asyncio.run(_prepare_db())
+    context = multiprocessing.get_context("spawn")
+    inboxes = [context.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(workers)]
+    controls = [context.Queue() for _ in range(workers)]
+    processes = [
+        context.Process(target=_worker_main, args=(index, inboxes, controls, build_application), name=f"shard-{index}")
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f"Запущено {workers} процессов-обработчиков.")
+
+    try:
+        asyncio.run(_serve_front(ShardRouter(inboxes), partial(_watch_workers, processes)))
+    finally:
+        for inbox, control, process in zip(inboxes, controls, processes):
+            if not process.is_alive():
+                continue
+            control.put(None)
+            try:
+                inbox.put(None, True, WORKER_STOP_TIMEOUT)
+            except queue.Full:
+                pass
+        for process in processes:
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"{process.name} не остановился за {WORKER_STOP_TIMEOUT} сек., завершаем принудительно.")
+                process.terminate()
@@ -1,81 +1,122 @@
+from functools import lru_cache
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-def get_main_menu_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton("🎲 Играть", callback_data="play")],
-        [
-            InlineKeyboardButton("💰 Баланс", callback_data="balance"),
-            InlineKeyboardButton("📜 Правила", callback_data="rules")
-        ],
-        [
-            InlineKeyboardButton("🏆 Топ игроков", callback_data="top"),
-            InlineKeyboardButton("👤 Мой ник", callback_data="set_nickname")
-        ],
-        [
-            InlineKeyboardButton("Пополнить баланс 💳", callback_data="deposit"),
-            InlineKeyboardButton("📤 Вывод средств", callback_data="withdraw")
-        ],
-        [InlineKeyboardButton("👥 Реферальная система", callback_data="referral_system")]
+class FrozenKeyboard(InlineKeyboardMarkup):
+    """Клавиатура, которая строится один раз: to_dict() вычисляется при создании и переиспользуется.
+
+    Объекты telegram неизменяемы после создания, поэтому одну клавиатуру можно
+    отправлять в любых ответах без повторной сборки и сериализации.
+    """
+
+    __slots__ = ("_dict",)
+
+    def __init__(self, inline_keyboard, **kwargs):
+        super().__init__(inline_keyboard, **kwargs)
+        with self._unfrozen():
+            self._dict = super().to_dict()
+
+    def to_dict(self, recursive: bool = True) -> dict:
+        return self._dict if recursive else super().to_dict(recursive)
+
+MAIN_MENU_KEYBOARD = FrozenKeyboard([
+    [InlineKeyboardButton("🎲 Играть", callback_data="play")],
+    [
+        InlineKeyboardButton("💰 Баланс", callback_data="balance"),
+        InlineKeyboardButton("📜 Правила", callback_data="rules")
+    ],
+    [
+        InlineKeyboardButton("🏆 Топ игроков", callback_data="top"),
+        InlineKeyboardButton("👤 Мой ник", callback_data="set_nickname")
+    ],
+    [
+        InlineKeyboardButton("Пополнить баланс 💳", callback_data="deposit"),
+        InlineKeyboardButton("📤 Вывод средств", callback_data="withdraw")
+    ],
+    [InlineKeyboardButton("👥 Реферальная система", callback_data="referral_system")]
+])
+
+BACK_TO_MENU_SIMPLE_KEYBOARD = FrozenKeyboard([[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_start")]])
+
+BACK_TO_MENU_NESTED_KEYBOARD = FrozenKeyboard([[InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu_from_nested")]])
+
+GAME_CHOICE_KEYBOARD = FrozenKeyboard([
+    [
+        InlineKeyboardButton("🎲", callback_data="game_dice"),
+        InlineKeyboardButton("🏀", callback_data="game_basketball"),
+        InlineKeyboardButton("⚽", callback_data="game_football"),
+        InlineKeyboardButton("🎰", callback_data="game_dart"),
+    ],
+    [InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu_from_nested")]
+])
+
+DEPOSIT_OPTIONS_KEYBOARD = FrozenKeyboard([
+    [
+        InlineKeyboardButton("100 ⭐", callback_data="deposit_100"),
+        InlineKeyboardButton("500 ⭐", callback_data="deposit_500"),
+        InlineKeyboardButton("1000 ⭐", callback_data="deposit_1000"),
+    ],
+    [InlineKeyboardButton("Другая сумма", callback_data="deposit_custom")],
+    [InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu_from_nested")]
+])
+
+POST_GAME_KEYBOARD = FrozenKeyboard([
+    [InlineKeyboardButton("⬅️ Назад в меню", callback_data="post_game_back_to_menu")],
+    [
+        InlineKeyboardButton("💰 Изменить ставку", callback_data="post_game_change_bet"),
+        InlineKeyboardButton("🔄 Играть снова", callback_data="post_game_play_again")
     ]
-    return InlineKeyboardMarkup(keyboard)
+])
+
+def get_main_menu_keyboard() -> InlineKeyboardMarkup:
+    return MAIN_MENU_KEYBOARD
 
 def get_back_to_menu_keyboard_simple() -> InlineKeyboardMarkup:
-    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_start")]]
-    return InlineKeyboardMarkup(keyboard)
+    return BACK_TO_MENU_SIMPLE_KEYBOARD
 
 def get_back_to_menu_keyboard_nested() -> InlineKeyboardMarkup:
-    keyboard = [[InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu_from_nested")]]
-    return InlineKeyboardMarkup(keyboard)
+    return BACK_TO_MENU_NESTED_KEYBOARD
 
 def get_game_choice_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [
-            InlineKeyboardButton("🎲", callback_data="game_dice"),
-            InlineKeyboardButton("🏀", callback_data="game_basketball"),
-            InlineKeyboardButton("⚽", callback_data="game_football"),
-            InlineKeyboardButton("🎰", callback_data="game_dart"),
-        ],
-        [InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu_from_nested")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return GAME_CHOICE_KEYBOARD
 
 def get_deposit_options_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [
-            InlineKeyboardButton("100 ⭐", callback_data="deposit_100"),
-            InlineKeyboardButton("500 ⭐", callback_data="deposit_500"),
-            InlineKeyboardButton("1000 ⭐", callback_data="deposit_1000"),
-        ],
-        [InlineKeyboardButton("Другая сумма", callback_data="deposit_custom")],
-        [InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu_from_nested")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return DEPOSIT_OPTIONS_KEYBOARD
 
 def get_post_game_keyboard() -> InlineKeyboardMarkup:
-    keyboard = [
-        [InlineKeyboardButton("⬅️ Назад в меню", callback_data="post_game_back_to_menu")],
-        [
-            InlineKeyboardButton("💰 Изменить ставку", callback_data="post_game_change_bet"),
-            InlineKeyboardButton("🔄 Играть снова", callback_data="post_game_play_again")
-        ]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return POST_GAME_KEYBOARD
 
 # ==================== РЕФЕРАЛЬНАЯ СИСТЕМА ====================
 
+# Клавиатура главного меню реферальной системы
+REFERRAL_MENU_KEYBOARD = FrozenKeyboard([
+    [InlineKeyboardButton("📊 Моя статистика", callback_data="show_referral_stats")],
+    [InlineKeyboardButton("🔗 Моя ссылка", callback_data="generate_referral_link")],
+    [InlineKeyboardButton("📋 Мои рефералы", callback_data="show_referral_list")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_start")]
+])
+
+# Клавиатура для страниц статистики рефералов
+REFERRAL_STATS_KEYBOARD = FrozenKeyboard([
+    [InlineKeyboardButton("⬅️ Назад", callback_data="referral_system")]
+])
+
 def get_referral_menu_keyboard() -> InlineKeyboardMarkup:
-    """Клавиатура главного меню реферальной системы"""
-    keyboard = [
-        [InlineKeyboardButton("📊 Моя статистика", callback_data="show_referral_stats")],
-        [InlineKeyboardButton("🔗 Моя ссылка", callback_data="generate_referral_link")],
-        [InlineKeyboardButton("📋 Мои рефералы", callback_data="show_referral_list")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_start")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return REFERRAL_MENU_KEYBOARD
 
 def get_referral_stats_keyboard() -> InlineKeyboardMarkup:
-    """Клавиатура для страниц статистики рефералов"""
-    keyboard = [
-        [InlineKeyboardButton("⬅️ Назад", callback_data="referral_system")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
\ No newline at end of file
+    return REFERRAL_STATS_KEYBOARD
+
+@lru_cache(maxsize=1024)
+def get_referral_list_keyboard(prev_cursor: tuple[int, int] | None, next_cursor: tuple[int, int] | None) -> InlineKeyboardMarkup:
+    """Клавиатура списка рефералов с переходом по страницам.
+
+    Курсор — пара (id записи-границы, номер первой строки страницы).
+    """
+    navigation = []
+    if prev_cursor:
+        navigation.append(InlineKeyboardButton("◀️ Новее", callback_data=f"ref_list:prev:{prev_cursor[0]}:{prev_cursor[1]}"))
+    if next_cursor:
+        navigation.append(InlineKeyboardButton("Старше ▶️", callback_data=f"ref_list:next:{next_cursor[0]}:{next_cursor[1]}"))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="referral_system")])
+    return FrozenKeyboard(keyboard)
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from typing import Any, Awaitable
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import metrics
+
+def ordering_key(update: object) -> int | None:
+    """Возвращает ключ, в пределах которого обновления должны идти строго по порядку"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+def raw_ordering_key(data: dict) -> int | None:
+    """То же, что ordering_key, но по JSON обновления — без построения объекта Update"""
+    for field, payload in data.items():
+        if field == "update_id" or not isinstance(payload, dict):
+            continue
+        user = payload.get("from") or payload.get("user")
+        if user:
+            return user["id"]
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления разных пользователей параллельно, а одного пользователя — по очереди.
+
+    Очередь пользователя соблюдается до захвата общего семафора: обновления, ждущие
+    предыдущих обновлений того же пользователя, не занимают слоты max_concurrent_updates.
+    """
+
+    __slots__ = ("_locks", "_pending")
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._pending: dict[int, int] = {}
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # Переопределяем помеченный @final метод: иначе замок пользователя ждали бы под семафором
+        start = time.perf_counter()
+        try:
+            await self._process_in_order(update, coroutine)
+        finally:
+            metrics.registry.observe("bot_update_seconds", time.perf_counter() - start)
+
+    async def _process_in_order(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = ordering_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._pending[key] = self._pending.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            # Освобождаем замок, когда у пользователя не осталось обновлений в очереди
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                del self._pending[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
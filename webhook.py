@@ -0,0 +1,227 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from contextlib import asynccontextmanager
+from telegram import Bot, Update
+from telegram.ext import Application
+from config import (
+    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL,
+    WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS, WEBHOOK_MAX_OPEN_CONNECTIONS, WEBHOOK_READ_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1024 * 1024
+# Строка запроса и заголовки вместе; длиннее — ответ 431
+MAX_HEADER_SIZE = 16 * 1024
+MAX_HEADER_LINES = 64
+# Простаивающее keep-alive соединение закрывается после этой паузы
+IDLE_TIMEOUT = 60
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+class WebhookServer:
+    """Минимальный HTTP/1.1 сервер, принимающий обновления Telegram по POST.
+
+    Тело запроса передается в on_update как словарь. Пока on_update не вернул
+    управление (например, ждет места в очереди обновлений), ответ не отправляется,
+    поэтому Telegram сам снижает темп доставки. ValueError из on_update означает
+    некорректное обновление и дает ответ 400.
+
+    Сервер может смотреть в интернет, поэтому каждое чтение ограничено read_timeout,
+    заголовки — MAX_HEADER_SIZE и MAX_HEADER_LINES, а открытые соединения — max_open.
+    """
+
+    def __init__(self, on_update, listen: str, port: int, path: str, secret_token: str | None, max_connections: int,
+                 max_open: int = WEBHOOK_MAX_OPEN_CONNECTIONS, read_timeout: float = WEBHOOK_READ_TIMEOUT):
+        self.on_update = on_update
+        self.listen = listen
+        self.port = port
+        self.path = "/" + path.lstrip("/")
+        self.secret_token = secret_token
+        self.max_open = max_open
+        self.read_timeout = read_timeout
+        self._requests = asyncio.Semaphore(max_connections)
+        self._server: asyncio.base_events.Server | None = None
+        self._connections: dict[asyncio.StreamWriter, asyncio.Task] = {}
+
+    async def start(self):
+        # limit: строка длиннее MAX_HEADER_SIZE не накапливается в буфере, readline бросает ValueError
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port, limit=MAX_HEADER_SIZE)
+        logger.info(f"Webhook слушает http://{self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            # Keep-alive соединения сами не закрываются, иначе wait_closed ждал бы клиента
+            for writer in self._connections:
+                writer.close()
+            await asyncio.gather(*self._connections.values(), return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if len(self._connections) >= self.max_open:
+            logger.warning(f"Webhook: открыто {len(self._connections)} соединений, новое отклонено")
+            try:
+                await self._respond(writer, 503, False)
+            except ConnectionError:
+                pass
+            writer.close()
+            return
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """Обрабатывает один запрос; возвращает True, если соединение остается открытым.
+
+        Чтение дольше таймаута бросает asyncio.TimeoutError, и соединение закрывается.
+        """
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+            if not request_line:
+                return False
+            headers = {}
+            size = len(request_line)
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                size += len(line)
+                if size > MAX_HEADER_SIZE or len(headers) >= MAX_HEADER_LINES:
+                    raise ValueError("слишком большие заголовки")
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        except ValueError:
+            # В том числе строка длиннее limit потока
+            await self._respond(writer, 431, False)
+            return False
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            await self._respond(writer, 400, False)
+            return False
+
+        keep_alive = headers.get("connection", "").lower() != "close"
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            # Без корректной длины не найти начало следующего запроса: закрываем соединение
+            await self._respond(writer, 400, False)
+            return False
+        if length > MAX_BODY_SIZE:
+            await self._respond(writer, 413, False)
+            return False
+        body = await asyncio.wait_for(reader.readexactly(length), self.read_timeout) if length else b""
+
+        if method != "POST" or target != self.path:
+            await self._respond(writer, 404, keep_alive)
+            return keep_alive
+        if self.secret_token and not hmac.compare_digest(
+            headers.get(SECRET_HEADER, "").encode("latin-1"), self.secret_token.encode("latin-1")
+        ):
+            await self._respond(writer, 403, keep_alive)
+            return keep_alive
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            await self._respond(writer, 400, keep_alive)
+            return keep_alive
+
+        # Ограничиваем число одновременно обрабатываемых запросов, а не открытых соединений:
+        # простаивающее keep-alive соединение не должно занимать слот
+        async with self._requests:
+            try:
+                await self.on_update(data)
+            except ValueError as e:
+                logger.warning(f"Отклонено некорректное обновление: {e}")
+                await self._respond(writer, 400, keep_alive)
+                return keep_alive
+        await self._respond(writer, 200, keep_alive)
+        return keep_alive
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, keep_alive: bool):
+        reason = {
+            200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large",
+            431: "Request Header Fields Too Large", 503: "Service Unavailable",
+        }[status]
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Length: 0\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+        )
+        await writer.drain()
+
+async def wait_for_stop_signal(signals=(signal.SIGINT, signal.SIGTERM)):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in signals:
+        loop.add_signal_handler(sig, stop_event.set)
+    await stop_event.wait()
+
+@asynccontextmanager
+async def running(application: Application):
+    """Запускает Application без Updater и останавливает его при выходе.
+
+    Повторяет жизненный цикл Application.run_polling/run_webhook, включая post_init/post_stop/post_shutdown.
+    """
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        yield application
+    finally:
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def make_server(on_update) -> WebhookServer:
+    return WebhookServer(on_update, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS)
+
+async def register_webhook(bot: Bot, server: WebhookServer):
+    # Без WEBHOOK_URL сервер работает локально: обновления можно присылать replay_updates.py
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + server.path,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+
+async def serve(application: Application):
+    """Обрабатывает обновления, пришедшие на WebhookServer, до сигнала остановки"""
+    async def on_update(data: dict):
+        try:
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            raise ValueError(f"обновление {data.get('update_id')} не разобрано: {e}") from e
+        await application.update_queue.put(update)
+
+    server = make_server(on_update)
+    async with running(application):
+        await server.start()
+        try:
+            await register_webhook(application.bot, server)
+            await wait_for_stop_signal()
+        finally:
+            await server.stop()
+
+def run(application: Application):
+    asyncio.run(serve(application))